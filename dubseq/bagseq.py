@@ -3,8 +3,10 @@ import sys
 import argparse
 import logging
 import subprocess
-from .core.barcode import Barcode, BarcodeTag, EMPTY_BARCODE, BarcodeStat, BarcodeLocation, BarcodeHits
-from .core.fastq import FastqReader, FastqRecord, FastqFileStat
+from .core.barcode import Barcode, BarcodeTag, EMPTY_BARCODE, BarcodeStat, BarcodeLocation, BarcodeHits, \
+    ExtractionCache
+from .core.fastq import FastqFileStat, open_fastq_reader
+from .core.pipeline import process_fastq_records
 from .core.blat import BlatReader, BlatRecord
 from .core import util
 
@@ -37,6 +39,12 @@ class Context:
     min_blat_block_size = None
     sim_ratio_threshold = None
     loc_ratio_threshold = None
+    prefetch_batches = None
+    extraction_cache_size = None
+    decompression_threads = None
+    up_sample_name = None
+    dn_sample_name = None
+    workers = None
 
     @staticmethod
     def build_context(args):
@@ -58,6 +66,12 @@ class Context:
         Context.min_blat_block_size = args.min_blat_block_size
         Context.sim_ratio_threshold = args.sim_ratio_threshold
         Context.loc_ratio_threshold = args.loc_ratio_threshold
+        Context.prefetch_batches = args.prefetch_batches
+        Context.extraction_cache_size = args.extraction_cache_size
+        Context.decompression_threads = args.decompression_threads
+        Context.up_sample_name = args.up_sample_name
+        Context.dn_sample_name = args.dn_sample_name
+        Context.workers = args.workers
 
     @staticmethod
     def fasta_fname(fname_prefix):
@@ -84,6 +98,12 @@ class Context:
         base_file_name = os.path.basename(fastq_file_name)
         return os.path.join(Context.output_dir, base_file_name + Context.BARCODES_FNAME_SUFFIX)
 
+    @staticmethod
+    def fasta_part_fname(fname_prefix, fastq_file_name):
+        base_file_name = os.path.basename(fastq_file_name)
+        return os.path.join(Context.output_dir, '%s.%s%s' % (
+            fname_prefix, base_file_name, Context.FASTA_FNAME_SUFFIX))
+
 
 def parse_args():
 
@@ -165,7 +185,8 @@ def parse_args():
 
     parser.add_argument('-u', '--input-up',
                         dest='input_up',
-                        help="""Upstream barcodes: fastq file (can be gzipped) or directory with fastq files (can be gzipped).
+                        help="""Upstream barcodes: fastq file (can be compressed) or directory with fastq files (can be compressed).
+                        Use - to read fastq records from stdin; named pipes are supported as well.
                         """,
                         type=str,
                         required=True
@@ -173,7 +194,8 @@ def parse_args():
 
     parser.add_argument('-d', '--input-down',
                         dest='input_down',
-                        help="""Downstream barcodes: fastq file (can be gzipped) or directory with fastq files (can be gzipped).
+                        help="""Downstream barcodes: fastq file (can be compressed) or directory with fastq files (can be compressed).
+                        Use - to read fastq records from stdin; named pipes are supported as well.
                         """,
                         type=str,
                         required=True
@@ -311,6 +333,60 @@ def parse_args():
                         type=int
                         )
 
+    parser.add_argument('--prefetch-batches',
+                        dest='prefetch_batches',
+                        help='''The number of batches of fastq records to read ahead in a background 
+                        thread (0 - read records in the main thread)
+                        ''',
+                        default=0,
+                        type=int
+                        )
+
+    parser.add_argument('--extraction-cache-size',
+                        dest='extraction_cache_size',
+                        help='''The number of tag windows of reads whose barcode search results are
+                        cached, so that the primers are not searched for again in duplicated reads
+                        (0 - no cache). The cache is used for reads that are not processed in
+                        batches of reads of the same length. The hit rate is reported in the log
+                        ''',
+                        default=ExtractionCache.DEFAULT_SIZE,
+                        type=int
+                        )
+
+    parser.add_argument('--decompression-threads',
+                        dest='decompression_threads',
+                        help='''The number of threads used to decompress fastq files (if supported by 
+                        the compression format and the installed decompression program)
+                        ''',
+                        default=4,
+                        type=int
+                        )
+
+    parser.add_argument('--up-sample-name',
+                        dest='up_sample_name',
+                        help='''The name of the up sample used to name output files instead of the name
+                        of the fastq file. It is required if fastq records are read from stdin (-u -)
+                        ''',
+                        type=str
+                        )
+
+    parser.add_argument('--dn-sample-name',
+                        dest='dn_sample_name',
+                        help='''The name of the down sample used to name output files instead of the name
+                        of the fastq file. It is required if fastq records are read from stdin (-d -)
+                        ''',
+                        type=str
+                        )
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        help='''The number of worker processes to process fastq files in parallel
+                        (the largest files are processed first)
+                        ''',
+                        default=1,
+                        type=int
+                        )
+
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(1)
@@ -319,7 +395,18 @@ def parse_args():
 
 
 def check_args(args):
-    pass
+    if args.input_up == util.STDIN and args.input_down == util.STDIN:
+        sys.exit('Only one of the up and down fastq sources can be read from stdin')
+
+    for source, sample_name, sample_name_arg in [
+            (args.input_up, args.up_sample_name, '--up-sample-name'),
+            (args.input_down, args.dn_sample_name, '--dn-sample-name')]:
+        if source == util.STDIN and not sample_name:
+            sys.exit('The %s parameter is required to read fastq records from stdin'
+                     % sample_name_arg)
+        if sample_name and os.path.isdir(source):
+            sys.exit('The %s parameter can not be used with a directory of fastq files'
+                     % sample_name_arg)
 
 
 def main():
@@ -328,11 +415,11 @@ def main():
 
     logging.info("Do up tags")
     process_barcodes(Context.up_tag_fastq_source, Context.up_tag,
-                     Context.UP_TAG_FNAME_PREFIX)
+                     Context.UP_TAG_FNAME_PREFIX, Context.up_sample_name)
 
     logging.info("Do dn tags")
     process_barcodes(Context.down_tag_fastq_source, Context.down_tag,
-                     Context.DOWN_TAG_FNAME_PREFIX)
+                     Context.DOWN_TAG_FNAME_PREFIX, Context.dn_sample_name)
 
     logging.info("Done!")
 
@@ -353,10 +440,10 @@ def init_logger():
         datefmt="%m/%d/%Y %I:%M:%S %p")
 
 
-def process_barcodes(fastq_source, tag, fname_prefix):
+def process_barcodes(fastq_source, tag, fname_prefix, sample_name=None):
 
     # process the source fastq files (extract barcodes, collect barcode stat, extract genomic sequences)
-    process_fastq_files(fastq_source, tag, fname_prefix)
+    process_fastq_files(fastq_source, tag, fname_prefix, sample_name)
 
     # do blat on the extracted genomic sequences
     run_blat(fname_prefix)
@@ -380,7 +467,7 @@ def process_blat_results(fname_prefix):
         genomic fragments to the genomic contigs
     '''
     # hashtable to accumulate genomic locations for each barcode
-    # hastable { barcode sequence => BarcodeLocation}
+    # hastable { packed barcode sequence => BarcodeLocation}
     barcode_locations = {}
 
     bhit_fp = open(Context.bhit_fname(fname_prefix), 'w')
@@ -430,11 +517,11 @@ def process_barcode_hits(bhit_fp, barcode_hits, barcode_locations):
 
     # collect location
     if barcode_hits.hits_count == 1 and max(barcode_hits.blat_max_block_sizes) >= Context.min_blat_block_size:
-        barcode_location = barcode_locations.get(
-            barcode_hits.barcode)
+        barcode_code = util.pack_sequence(barcode_hits.barcode)
+        barcode_location = barcode_locations.get(barcode_code)
         if not barcode_location:
             barcode_location = BarcodeLocation()
-            barcode_locations[barcode_hits.barcode] = barcode_location
+            barcode_locations[barcode_code] = barcode_location
 
         barcode_location.add_location(
             barcode_hits.blat_contig_ids[0],
@@ -455,7 +542,7 @@ class _SequenceIdGenerator:
         return self.__id
 
 
-def process_fastq_files(fastq_source, tag, fname_prefix):
+def process_fastq_files(fastq_source, tag, fname_prefix, sample_name=None):
     '''
         As a result of the fastq files processeing (sepearately for the up and down tags)
         three types of info will be collected:
@@ -475,24 +562,76 @@ def process_fastq_files(fastq_source, tag, fname_prefix):
     fasta_fp = open(Context.fasta_fname(fname_prefix), 'w')
     try:
         # proces all fastq files (extract genomic regions and colect barcodes)
-        util.process_fastq_files(
-            fastq_source,
-            process_fastq_file,
-            tag,
-            seq_id_generator,
-            fasta_fp)
+        if Context.workers > 1:
+            # each worker stores genomic regions in a separate fasta file,
+            # which is appended to the combined one
+            util.process_fastq_files(
+                fastq_source,
+                process_fastq_file_part,
+                tag,
+                fname_prefix,
+                sample_name,
+                workers=Context.workers,
+                callback=lambda fastq_fname, results: merge_fasta_part(
+                    fastq_fname, results, seq_id_generator, fasta_fp))
+        else:
+            util.process_fastq_files(
+                fastq_source,
+                process_fastq_file,
+                tag,
+                seq_id_generator,
+                fasta_fp,
+                sample_name,
+                callback=log_fastq_file_stat)
 
     finally:
         fasta_fp.close()
 
 
-def process_fastq_file(fastq_fname, tag, seq_id_generator, fasta_fp):
+def process_fastq_file_part(fastq_fname, tag, fname_prefix, sample_name=None):
+    '''
+        Processes fastq file in a worker process. The extracted genomic sequences
+        are stored in a separate fasta file with the sequence ids starting from 1
+    '''
+    fasta_part_fname = Context.fasta_part_fname(fname_prefix, sample_name or fastq_fname)
+    with open(fasta_part_fname, 'w') as fasta_fp:
+        fastq_file_stat = process_fastq_file(
+            fastq_fname, tag, _SequenceIdGenerator(), fasta_fp, sample_name)
+
+    return fastq_file_stat, fasta_part_fname
+
+
+def merge_fasta_part(fastq_fname, results, seq_id_generator, fasta_fp):
+    '''
+        Appends the fasta file of a processed fastq file to the combined fasta file
+        and renumbers its sequences
+    '''
+    fastq_file_stat, fasta_part_fname = results
+    with open(fasta_part_fname) as f:
+        for line in f:
+            if line.startswith('>'):
+                # replace the id in the ">id:barcode record_id" header
+                line = '>' + str(seq_id_generator.next()) + line[line.index(':'):]
+            fasta_fp.write(line)
+    os.remove(fasta_part_fname)
+
+    log_fastq_file_stat(fastq_fname, fastq_file_stat)
+
+
+def log_fastq_file_stat(fastq_fname, fastq_file_stat):
+    logging.info("%s\t%s" % (fastq_fname, str(fastq_file_stat)))
+    for extraction_stat in fastq_file_stat.extraction_stats:
+        logging.info("%s\t%s" % (fastq_fname, extraction_stat))
+
+
+def process_fastq_file(fastq_fname, tag, seq_id_generator, fasta_fp, sample_name=None):
     '''
         It will:
         1. try to extract a barcode
         2. store the extracted barcode in barcodes file
         3. store the high quality barcode in barcode_stats for the downstream analysis
         4. extract a genomic sequnece for the high quality barcode and store in fasta file
+        Returns the file stat to be logged
     '''
 
     print("Doing file:%s" % fastq_fname)
@@ -500,53 +639,61 @@ def process_fastq_file(fastq_fname, tag, seq_id_generator, fasta_fp):
     # To collect a general stats on the processed fastq file (will be logged)
     fastq_file_stat = FastqFileStat()
 
-    # open a file to accumulate extracted barcodes
-    barcodes_fp = open(Context.barcodes_fname(fastq_fname), 'w')
-    barcodes_fp.write("seq_id\t%s\n" % Barcode.header())
+    # extracts barcodes from batches of reads
+    # we will not requre the primer2 being entirely present in the
+    # read, since the read is short...
+    barcode_matcher = tag.compile(Context.primer_position_shifts, require_entire_primer2=False,
+                                  cache_size=Context.extraction_cache_size)
 
-    try:
-        # open fastq file reader
-        reader = FastqReader(fastq_fname)
-        try:
-            record = FastqRecord()
-            while reader.next_record(record):
+    def process_record(record, barcode):
+
+        # count the total amount of the processed reads
+        fastq_file_stat.total_reads_inc()
+
+        if not barcode:
+            return None
 
-                # count the total amount of the processed reads
-                fastq_file_stat.total_reads_inc()
+        # count the reads with extracted barcodes
+        fastq_file_stat.barcode_extracted_reads_inc()
 
-                # try to extract a barcode from the sequence
-                # we will not requre the primer2 being entirely present in the
-                # read, since the read is short...
-                barcode = tag.extract_barcode(
-                    record, Context.primer_position_shifts, require_entire_primer2=False)
+        # store the extracted barcode
+        record_id = record.id.split(' ')[0]
+        barcode_line = "%s\t%s\n" % (record_id, barcode)
 
-                if barcode:
-                    # count the reads with extracted barcodes
-                    fastq_file_stat.barcode_extracted_reads_inc()
+        fasta_lines = None
+        if barcode.min_quality >= Context.min_barcode_quality:
 
-                    # store the extracted barcode
-                    record_id = record.id.split(' ')[0]
-                    barcodes_fp.write("%s\t%s\n" % (record_id, barcode))
+            # Extract a genomic sequence
+            genomic_sequence = record.sequence[tag.tag_end:]
 
-                if barcode and barcode.min_quality >= Context.min_barcode_quality:
+            # if sequence is long enough, store in fasta file
+            if len(genomic_sequence) >= Context.min_genomic_sequence_length:
+                seq_id = seq_id_generator.next()
+                fasta_lines = '>' + str(seq_id) + ":" + barcode.sequence + " " + record.id + '\n' \
+                    + genomic_sequence + '\n'
 
-                    # Extract a genomic sequence
-                    genomic_sequence = record.sequence[tag.tag_end:]
+        return barcode_line, fasta_lines
 
-                    # if sequence is long enough, store in fasta file
-                    if len(genomic_sequence) >= Context.min_genomic_sequence_length:
-                        seq_id = seq_id_generator.next()
-                        fasta_fp.write('>' + str(seq_id) + ":" +
-                                       barcode.sequence + " " + record.id + '\n')
-                        fasta_fp.write(genomic_sequence + '\n')
+    # open a file to accumulate extracted barcodes
+    barcodes_fp = open(Context.barcodes_fname(sample_name or fastq_fname), 'w')
+    barcodes_fp.write("seq_id\t%s\n" % Barcode.header())
 
+    try:
+        # open fastq file reader
+        reader = open_fastq_reader(fastq_fname, Context.prefetch_batches,
+                                   threads=Context.decompression_threads)
+        try:
+            # read, process records and write barcodes and genomic sequences in parallel threads
+            process_fastq_records(reader, process_record, [barcodes_fp, fasta_fp],
+                                  [barcode_matcher.extract_barcodes])
         finally:
             reader.close()
     finally:
         barcodes_fp.close()
 
-    # Log the file stat
-    logging.info("%s\t%s" % (fastq_fname, str(fastq_file_stat)))
+    fastq_file_stat.add_extraction_stats(barcode_matcher)
+
+    return fastq_file_stat
 
 
 if __name__ == '__main__':
@@ -4,15 +4,22 @@ import sys
 import argparse
 import logging
 import pandas as pd
-from .core.barcode import Barcode, BarcodeTag, BarcodeStat
-from .core.fastq import FastqReader, FastqRecord, FastqFileStat
+from .core.barcode import Barcode, BarcodeTag, BarcodeStat, BarcodeStatTable, \
+    ExtractionCache
+from .core.counter import BarcodeCounter
+from .core.library import BarcodeLibrary, LibraryCounter
+from .core.fastq import FastqFileStat, open_fastq_reader
+from .core.pipeline import process_fastq_records
 from .core import util
 
 
 class Context:
     BARCODES_FNAME_SUFFIX = '.barcodes'
     BARCODE_STAT_FNAME_SUFFIX = '.bstat.tsv'
+    BARCODE_CLUSTER_FNAME_SUFFIX = '.bcluster.tsv'
+    LIBRARY_COUNTS_FNAME_SUFFIX = '.lcounts.tsv'
     LOG_FILE_NAME = 'barseq.log'
+    MANIFEST_FILE_NAME = 'barseq.manifest.tsv'
     ITNUM_PATTERN = re.compile(r'(?:^|_)(IT\d+)[_\.]')
     SNUM_PATTERN = re.compile(r'(?:^|_)(S\d+)[_\.]')
 
@@ -22,16 +29,32 @@ class Context:
     primer_position_shifts = None
     min_barcode_quality = None
     sim_ratio_threshold = None
+    sim_max_distance = None
+    sim_indels = None
+    cluster = None
+    library_file_name = None
     index2_file_name = None
     mode = None
+    prefetch_batches = None
+    extraction_cache_size = None
+    decompression_threads = None
+    sample_name = None
+    workers = None
+    watch = None
+    watch_interval = None
+    watch_timeout = None
 
     index2_df = None
+    library = None
 
     @staticmethod
     def to_string(delimiter=' '):
         props = ['mode', 'fastq_source', 'output_dir', 'barcode_tag',
                  'primer_position_shifts', 'min_barcode_quality',
-                 'sim_ratio_threshold', 'index2_file_name']
+                 'sim_ratio_threshold', 'sim_max_distance', 'sim_indels', 'cluster',
+                 'library_file_name', 'index2_file_name', 'prefetch_batches',
+                 'extraction_cache_size', 'decompression_threads', 'sample_name', 'workers',
+                 'watch', 'watch_interval', 'watch_timeout']
 
         return delimiter.join(['%s = %s' % (prop, Context.__dict__[prop])
                                for prop in props])
@@ -72,25 +95,62 @@ class Context:
         Context.output_dir = args.output
         Context.min_barcode_quality = args.min_barcode_quality
         Context.sim_ratio_threshold = args.sim_ratio_threshold
+        Context.sim_max_distance = args.sim_max_distance
+        Context.sim_indels = args.sim_indels
+        Context.cluster = args.cluster
+        Context.library_file_name = args.library_file_name
+        Context.prefetch_batches = args.prefetch_batches
+        Context.extraction_cache_size = args.extraction_cache_size
+        Context.decompression_threads = args.decompression_threads
+        Context.sample_name = args.sample_name
+        Context.workers = args.workers
+        Context.watch = args.watch
+        Context.watch_interval = args.watch_interval
+        Context.watch_timeout = args.watch_timeout
 
         if mode == 'bs4':
             Context.index2_file_name = args.index2_file_name
             Context.index2_df = pd.read_csv(Context.index2_file_name, sep='\t')
 
+        if Context.library_file_name:
+            Context.library = BarcodeLibrary.load_bpag(Context.library_file_name)
+
+    @staticmethod
+    def base_fname(fastq_file_name):
+        if Context.sample_name:
+            return Context.sample_name
+        return os.path.basename(fastq_file_name)
+
     @staticmethod
     def barcodes_fname(fastq_file_name):
-        base_file_name = os.path.basename(fastq_file_name)
+        base_file_name = Context.base_fname(fastq_file_name)
         return os.path.join(Context.output_dir, base_file_name + Context.BARCODES_FNAME_SUFFIX)
 
     @staticmethod
     def bstat_fname(fastq_file_name):
-        base_file_name = os.path.basename(fastq_file_name)
+        base_file_name = Context.base_fname(fastq_file_name)
         return os.path.join(Context.output_dir, base_file_name + Context.BARCODE_STAT_FNAME_SUFFIX)
 
+    @staticmethod
+    def bcluster_fname(fastq_file_name):
+        base_file_name = Context.base_fname(fastq_file_name)
+        return os.path.join(Context.output_dir,
+                            base_file_name + Context.BARCODE_CLUSTER_FNAME_SUFFIX)
+
+    @staticmethod
+    def lcounts_fname(fastq_file_name):
+        base_file_name = Context.base_fname(fastq_file_name)
+        return os.path.join(Context.output_dir,
+                            base_file_name + Context.LIBRARY_COUNTS_FNAME_SUFFIX)
+
     @staticmethod
     def log_fname():
         return os.path.join(Context.output_dir, Context.LOG_FILE_NAME)
 
+    @staticmethod
+    def manifest_fname():
+        return os.path.join(Context.output_dir, Context.MANIFEST_FILE_NAME)
+
 
 def parse_args():
 
@@ -127,6 +187,9 @@ def parse_args():
         Bagseq program produces the following types of files:
         1. *.barcodes - file that has all extracted barcodes (for each source fastq file)
         2. *.bstat.tsv - file with statistics of extracted barcodes (for each source fastq file)
+        3. *.bcluster.tsv - file with clusters of similar barcodes (if --cluster is used)
+        4. *.lcounts.tsv - file with reads counts of library barcodes (if --library is used,
+        instead of *.bstat.tsv)
 
 
         Examples to run the barseq program:
@@ -139,8 +202,9 @@ def parse_args():
 
     parser.add_argument('-i', '--input',
                         dest='input',
-                        help="""fastq file (can be gzipped) or directory with fastq files (can be gzipped).
-                        If it is a directory, each file will be processed separately""",
+                        help="""fastq file (can be compressed) or directory with fastq files (can be compressed).
+                        If it is a directory, each file will be processed separately.
+                        Use - to read fastq records from stdin; named pipes are supported as well""",
                         type=str,
                         required=True
                         )
@@ -217,6 +281,114 @@ def parse_args():
                         type=int
                         )
 
+    parser.add_argument('--sim-max-distance',
+                        dest='sim_max_distance',
+                        help='''The maximum number of substitutions between a given barcode and
+                        a similar barcode
+                        ''',
+                        default=1,
+                        type=int
+                        )
+
+    parser.add_argument('--sim-indels',
+                        dest='sim_indels',
+                        help='''Consider barcodes that differ from a given barcode by one indel
+                        (which shifts the rest of the barcode) to be similar as well
+                        ''',
+                        action='store_true'
+                        )
+
+    parser.add_argument('--cluster',
+                        dest='cluster',
+                        help='''Cluster barcodes in the order of decreasing abundance: a barcode
+                        absorbs reads of its similar barcodes, which are at least --sim-ratio-threshold
+                        times less abundant. The clusters are saved in *.bcluster.tsv files
+                        ''',
+                        action='store_true'
+                        )
+
+    parser.add_argument('--library',
+                        dest='library_file_name',
+                        help='''BPAG file with the library of barcodes (up barcodes of the recommended
+                        barcode pairs). Only reads of the library barcodes are counted (a barcode that
+                        differs by one nucleotide from exactly one library barcode is counted for this
+                        barcode), and the counts of all library barcodes are saved in *.lcounts.tsv
+                        files instead of *.bstat.tsv files
+                        ''',
+                        type=str
+                        )
+
+    parser.add_argument('--prefetch-batches',
+                        dest='prefetch_batches',
+                        help='''The number of batches of fastq records to read ahead in a background 
+                        thread (0 - read records in the main thread)
+                        ''',
+                        default=0,
+                        type=int
+                        )
+
+    parser.add_argument('--extraction-cache-size',
+                        dest='extraction_cache_size',
+                        help='''The number of tag windows of reads whose barcode search results are
+                        cached, so that the primers are not searched for again in duplicated reads
+                        (0 - no cache). The cache is used for reads that are not processed in
+                        batches of reads of the same length. The hit rate is reported in the log
+                        ''',
+                        default=ExtractionCache.DEFAULT_SIZE,
+                        type=int
+                        )
+
+    parser.add_argument('--decompression-threads',
+                        dest='decompression_threads',
+                        help='''The number of threads used to decompress fastq files (if supported by 
+                        the compression format and the installed decompression program)
+                        ''',
+                        default=4,
+                        type=int
+                        )
+
+    parser.add_argument('--sample-name',
+                        dest='sample_name',
+                        help='''The name of the sample used to name output files instead of the name
+                        of the fastq file. It is required if fastq records are read from stdin (-i -)
+                        ''',
+                        type=str
+                        )
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        help='''The number of worker processes to process fastq files in parallel
+                        (the largest files are processed first) and to search for similar barcodes
+                        ''',
+                        default=1,
+                        type=int
+                        )
+
+    parser.add_argument('--watch',
+                        dest='watch',
+                        help='''Watch the input directory and process each fastq file as soon as
+                        it is complete (its size did not change for --watch-interval seconds).
+                        The processed files are recorded in the manifest file in the output
+                        directory, so they are not processed again after a restart
+                        ''',
+                        action='store_true')
+
+    parser.add_argument('--watch-interval',
+                        dest='watch_interval',
+                        help='The interval in seconds between checks of the input directory',
+                        default=60,
+                        type=int
+                        )
+
+    parser.add_argument('--watch-timeout',
+                        dest='watch_timeout',
+                        help='''Stop watching if no fastq file was added or changed for the given
+                        number of seconds (0 - watch until interrupted)
+                        ''',
+                        default=3600,
+                        type=int
+                        )
+
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(1)
@@ -225,24 +397,59 @@ def parse_args():
 
 
 def check_args(args):
-    pass
+    if args.input == util.STDIN and not args.sample_name:
+        sys.exit('The --sample-name parameter is required to read fastq records from stdin')
+
+    if args.sample_name and os.path.isdir(args.input):
+        sys.exit('The --sample-name parameter can not be used with a directory of fastq files')
+
+    # the sample number is taken from the sample name to find its index2 in bs4 mode
+    if args.bs4 and args.sample_name and not Context.SNUM_PATTERN.findall(args.sample_name):
+        sys.exit('The --sample-name parameter should contain the sample number (e.g. _S1_) '
+                 'in the bs4 mode: %s' % args.sample_name)
+
+    if args.sim_max_distance < 1:
+        sys.exit('The --sim-max-distance parameter should be at least 1')
+
+    if args.library_file_name and args.cluster:
+        sys.exit('The --cluster parameter can not be used with the --library parameter')
+
+    if args.watch and not os.path.isdir(args.input):
+        sys.exit('The --watch parameter requires a directory with fastq files')
 
 
 def main():
     BarcodeStat.SIM_RATIO_THRESHOLD = Context.sim_ratio_threshold
+    BarcodeStat.SIM_MAX_DISTANCE = Context.sim_max_distance
+    BarcodeStat.SIM_INDELS = Context.sim_indels
 
     # process file(s)
-    logging.info("Processing fastq files started")
-
-    util.process_fastq_files(
-        Context.fastq_source,
-        process_fastq_file)
+    if Context.watch:
+        logging.info("Watching fastq files started")
+
+        util.watch_fastq_files(
+            Context.fastq_source,
+            process_fastq_file,
+            Context.manifest_fname(),
+            workers=Context.workers,
+            callback=log_fastq_file_stat,
+            interval=Context.watch_interval,
+            timeout=Context.watch_timeout)
+    else:
+        logging.info("Processing fastq files started")
+
+        util.process_fastq_files(
+            Context.fastq_source,
+            process_fastq_file,
+            workers=Context.workers,
+            callback=log_fastq_file_stat)
 
     logging.info("Done!")
 
 
 def init_logger():
-    with open(Context.log_fname(), 'w') as f:
+    # keep the log of the previous runs in the watch mode, since they are continued
+    with open(Context.log_fname(), 'a' if Context.watch else 'w') as f:
         f.write('Command line: %s\n' % ' '.join(sys.argv))
 
         f.write("Parameters: \n\t%s \n" % Context.to_string('\n\t'))
@@ -261,37 +468,73 @@ def process_fastq_file(fastq_fname):
     ''' Process fastq file.
         1. Extracts barcodes
         2. Collect stats on barcode frequency and similar barcodes (that differs by 1 nucleotide)
+        Returns the file stat to be logged
     '''
     print("Doing file:%s" % fastq_fname)
 
-    # Hashtable to accumulate barcodes extracted from all fastq files
-    # it is a hashtable: {barcode sequnece => BarcodeStat}
-    barcode_stats = {}
+    if Context.library:
+        return process_fastq_file_library(fastq_fname)
+
+    # To count reads of barcodes extracted from the fastq file
+    barcode_counter = BarcodeCounter()
 
     # To collect a general stats on the processed fastq file (will be logged)
     fastq_file_stat = FastqFileStat()
 
     print("\tExtracting barcodes...")
-    extract_barcodes(fastq_fname, barcode_stats, fastq_file_stat)
+    extract_barcodes(fastq_fname, barcode_counter, fastq_file_stat)
 
     print("\tProcessing stat...")
+    # Stats of barcodes extracted from the fastq file in columns:
+    # the packed barcode sequences and their reads counts in the order of the counter
+    barcode_stats = BarcodeStatTable(*barcode_counter.arrays())
+
     # Identify similar barcodes and collect number of reads supporintg similar barcodes
-    BarcodeStat.find_similar_barcodes(barcode_stats)
+    similar_pairs = barcode_stats.find_similar_barcodes(Context.workers)
 
     # Store barcoe stat
-    BarcodeStat.save_barcode_stats(
-        Context.bstat_fname(fastq_fname), barcode_stats)
+    barcode_stats.save_barcode_stats(Context.bstat_fname(fastq_fname))
+
+    if Context.cluster:
+        print("\tClustering barcodes...")
+        barcode_parents = barcode_stats.cluster_barcodes(similar_pairs)
+        barcode_stats.save_barcode_clusters(
+            Context.bcluster_fname(fastq_fname), barcode_parents)
+
+    return fastq_file_stat
+
+
+def process_fastq_file_library(fastq_fname):
+    ''' Process fastq file counting reads of the library barcodes only.
+        Returns the file stat to be logged
+    '''
+    # To count reads of library barcodes in a dense array
+    library_counter = LibraryCounter(Context.library)
+
+    # To collect a general stats on the processed fastq file (will be logged)
+    fastq_file_stat = FastqFileStat()
+
+    print("\tExtracting barcodes...")
+    extract_barcodes(fastq_fname, library_counter, fastq_file_stat)
+
+    print("\tLibrary barcode reads: %s" % str(library_counter))
+    library_counter.save(Context.lcounts_fname(fastq_fname))
+
+    return fastq_file_stat
 
-    # Log the file stat
+
+def log_fastq_file_stat(fastq_fname, fastq_file_stat):
     logging.info("%s\t%s" % (fastq_fname, str(fastq_file_stat)))
+    for extraction_stat in fastq_file_stat.extraction_stats:
+        logging.info("%s\t%s" % (fastq_fname, extraction_stat))
 
 
 def get_file_itnum(fastq_fname):
-    base_file_name = os.path.basename(fastq_fname)
+    base_file_name = Context.base_fname(fastq_fname)
     return Context.ITNUM_PATTERN.findall(base_file_name)[0]
 
 def get_file_snum(fastq_fname):
-    base_file_name = os.path.basename(fastq_fname)
+    base_file_name = Context.base_fname(fastq_fname)
     return Context.SNUM_PATTERN.findall(base_file_name)[0]
 
 
@@ -300,14 +543,17 @@ def check_index2(fastq_record, index2_seq, index2_nN):
     return index2_seq == upstream_sequence
 
 
-def extract_barcodes(fastq_fname, barcode_stats, fastq_file_stat):
+def extract_barcodes(fastq_fname, barcode_counter, fastq_file_stat):
     '''
         It will:
         1. try to extract a barcode
         2. store the extracted barcode in barcodes file
-        3. store the high quality barcode in barcode_stats for the downstream analysis
+        3. count the high quality barcodes of each batch of reads in barcode_counter
+           (BarcodeCounter or LibraryCounter) for the downstream analysis
     '''
 
+    index2_seq = None
+    index2_nN = None
     if Context.mode == 'bs4':
         snum = get_file_snum(fastq_fname)
         df = Context.index2_df
@@ -315,56 +561,62 @@ def extract_barcodes(fastq_fname, barcode_stats, fastq_file_stat):
         index2_seq = df.iloc[0].index2
         index2_nN = int(df.iloc[0].nN)
 
-    # open a file to accumulate extracted barcodes
-    barcodes_fp = open(Context.barcodes_fname(fastq_fname), 'w')
-    barcodes_fp.write("seq_id\t%s\tindex2\n" % Barcode.header())
-
-    try:
-        # open fastq file reader
-        reader = FastqReader(fastq_fname)
-        try:
-            record = FastqRecord()
-            while reader.next_record(record):
+    # extracts barcodes from batches of reads
+    barcode_matcher = Context.barcode_tag.compile(
+        Context.primer_position_shifts, require_entire_primer2=False,
+        cache_size=Context.extraction_cache_size)
 
-                # count the total amount of the processed reads
-                fastq_file_stat.total_reads_inc()
+    min_barcode_quality = Context.min_barcode_quality
 
+    def extract_batch(batch):
+        # the barcodes (code, min quality, text) and the index2 check of each record
+        barcodes = barcode_matcher.extract_packed_barcodes(batch)
+        if Context.mode == 'bs4':
+            has_index2 = [check_index2(record, index2_seq, index2_nN) for record in batch]
+        else:
+            has_index2 = [True] * len(barcodes)
 
-                # try to extract a barcode from the sequence
-                barcode = Context.barcode_tag.extract_barcode(
-                    record, Context.primer_position_shifts, require_entire_primer2=False)
+        # count the high quality barcodes of the batch in the barcode_counter at once
+        barcode_counter.add([barcode[0] for barcode, _has_index2 in zip(barcodes, has_index2)
+                             if barcode and barcode[1] >= min_barcode_quality and _has_index2])
+        return list(zip(barcodes, has_index2))
 
-                
-                if barcode:
-                    # count the reads with extracted barcodes
-                    fastq_file_stat.barcode_extracted_reads_inc()
+    def process_record(record, values):
 
-  
+        # count the total amount of the processed reads
+        fastq_file_stat.total_reads_inc()
 
-                has_index2= True
-                if Context.mode == 'bs4':
-                    has_index2 = check_index2(record, index2_seq, index2_nN)
+        barcode, has_index2 = values
+        if barcode:
+            # count the reads with extracted barcodes
+            fastq_file_stat.barcode_extracted_reads_inc()
 
-                    # store the extracted barcode
-                    record_id = record.id.split(' ')[0]
-                    barcodes_fp.write("%s\t%s\t%s\n" %
-                                      (record_id, barcode, has_index2))
+        line = None
+        if Context.mode == 'bs4':
+            # store the extracted barcode
+            record_id = record.id.split(' ')[0]
+            line = "%s\t%s\t%s\n" % (record_id, barcode[2] if barcode else None, has_index2)
 
-                if barcode and barcode.min_quality >= Context.min_barcode_quality and has_index2:
+        return (line,)
 
-                    # register barcode in the barcode_stats
-                    barcode_key = barcode.sequence
-                    barcode_stat = barcode_stats.get(barcode_key)
-                    if not barcode_stat:
-                        barcode_stat = BarcodeStat()
-                        barcode_stats[barcode_key] = barcode_stat
+    # open a file to accumulate extracted barcodes
+    barcodes_fp = open(Context.barcodes_fname(fastq_fname), 'w')
+    barcodes_fp.write("seq_id\t%s\tindex2\n" % Barcode.header())
 
-                    barcode_stat.reads_count_inc()
+    try:
+        # open fastq file reader
+        reader = open_fastq_reader(fastq_fname, Context.prefetch_batches,
+                                   threads=Context.decompression_threads)
+        try:
+            # read, process records and write barcodes in parallel threads
+            process_fastq_records(reader, process_record, [barcodes_fp], [extract_batch])
         finally:
             reader.close()
     finally:
         barcodes_fp.close()
 
+    fastq_file_stat.add_extraction_stats(barcode_matcher)
+
 
 if __name__ == '__main__':
     args = parse_args()
@@ -3,18 +3,26 @@ import sys
 import argparse
 import logging
 import struct
-from .core.barcode import Barcode, BarcodeTag, EMPTY_BARCODE, BarcodeStat, PairedBarcodeStat
-from .core.fastq import FastqReader, FastqRecord, FastqFileStat
+import collections
+from .core.barcode import Barcode, BarcodeTag, EMPTY_BARCODE, BarcodeStat, PairedBarcodeStat, \
+    PairedBarcodeStatTable, ExtractionCache, MultiTagMatcher
+from .core.counter import BarcodeCounter
+from .core.pairs import BarcodePairs
+from .core.fastq import FastqFileStat, open_fastq_reader
+from .core.pipeline import process_fastq_records
 from .core import util
 
 
 class Context:
-    BARCODE_SEPARATOR = '='
     BARCODE_PAIR_STAT_FILE_NAME = 'bpseq.tsv'
     BARCODE_UP_STAT_FILE_NAME = 'up.bstat.tsv'
     BARCODE_DN_STAT_FILE_NAME = 'dn.bstat.tsv'
+    BARCODE_UP_CLUSTER_FILE_NAME = 'up.bcluster.tsv'
+    BARCODE_DN_CLUSTER_FILE_NAME = 'dn.bcluster.tsv'
     BARCODES_FILE_SUFFIX = '.barcodes'
     LOG_FILE_NAME = 'bpseq.log'
+    # the number of barcode pairs written to bpseq.tsv at once
+    BARCODE_PAIRS_CHUNK_SIZE = 1 << 16
 
     output_dir = None
     up_tag = None
@@ -23,7 +31,15 @@ class Context:
     min_barcode_quality = None
     file_stat = None
     sim_ratio_threshold = None
+    sim_max_distance = None
+    sim_indels = None
+    cluster = None
     chim_ratio_threshold = None
+    prefetch_batches = None
+    extraction_cache_size = None
+    decompression_threads = None
+    sample_name = None
+    workers = None
 
     @staticmethod
     def build_context(args):
@@ -37,7 +53,15 @@ class Context:
         Context.primer_position_shifts = args.shift
         Context.min_barcode_quality = args.min_barcode_quality
         Context.sim_ratio_threshold = args.sim_ratio_threshold
+        Context.sim_max_distance = args.sim_max_distance
+        Context.sim_indels = args.sim_indels
+        Context.cluster = args.cluster
         Context.chim_ratio_threshold = args.chim_ratio_threshold
+        Context.prefetch_batches = args.prefetch_batches
+        Context.extraction_cache_size = args.extraction_cache_size
+        Context.decompression_threads = args.decompression_threads
+        Context.sample_name = args.sample_name
+        Context.workers = args.workers
 
     @staticmethod
     def log_fname():
@@ -55,9 +79,23 @@ class Context:
     def barcode_dn_stat_fname():
         return os.path.join(Context.output_dir, Context.BARCODE_DN_STAT_FILE_NAME)
 
+    @staticmethod
+    def barcode_up_cluster_fname():
+        return os.path.join(Context.output_dir, Context.BARCODE_UP_CLUSTER_FILE_NAME)
+
+    @staticmethod
+    def barcode_dn_cluster_fname():
+        return os.path.join(Context.output_dir, Context.BARCODE_DN_CLUSTER_FILE_NAME)
+
+    @staticmethod
+    def base_fname(fastq_fname):
+        if Context.sample_name:
+            return Context.sample_name
+        return os.path.basename(fastq_fname)
+
     @staticmethod
     def barcodes_fname(fastq_fname):
-        base_file_name = os.path.basename(fastq_fname)
+        base_file_name = Context.base_fname(fastq_fname)
         return os.path.join(Context.output_dir, base_file_name + Context.BARCODES_FILE_SUFFIX)
 
 
@@ -112,6 +150,8 @@ def parse_args():
         3. dn.bstat.tsv - statistics for the down barcodes
         4. bpseq.tsv - the main output file with barcode paris, statistics  and recomendation 
         flags
+        and, if --cluster is used, up.bcluster.tsv and dn.bcluster.tsv - clusters of similar
+        up and down barcodes
 
         Examples to run the bpseq program:
 
@@ -122,8 +162,9 @@ def parse_args():
 
     parser.add_argument('-i', '--input',
                         dest='input',
-                        help='''fastq file (can be gzipped) or directory with fastq files 
-                        (can be gzipped).''',
+                        help='''fastq file (can be compressed) or directory with fastq files 
+                        (can be compressed). Use - to read fastq records from stdin; named pipes
+                        are supported as well.''',
                         type=str,
                         required=True
                         )
@@ -216,6 +257,32 @@ def parse_args():
                         type=int
                         )
 
+    parser.add_argument('--sim-max-distance',
+                        dest='sim_max_distance',
+                        help='''The maximum number of substitutions between a given barcode and
+                        a similar barcode
+                        ''',
+                        default=1,
+                        type=int
+                        )
+
+    parser.add_argument('--sim-indels',
+                        dest='sim_indels',
+                        help='''Consider barcodes that differ from a given barcode by one indel
+                        (which shifts the rest of the barcode) to be similar as well
+                        ''',
+                        action='store_true'
+                        )
+
+    parser.add_argument('--cluster',
+                        dest='cluster',
+                        help='''Cluster barcodes in the order of decreasing abundance: a barcode
+                        absorbs reads of its similar barcodes, which are at least --sim-ratio-threshold
+                        times less abundant. The clusters are saved in up.bcluster.tsv and dn.bcluster.tsv files
+                        ''',
+                        action='store_true'
+                        )
+
     parser.add_argument('-c', '--chim-ratio-threshold',
                         dest='chim_ratio_threshold',
                         help='''The minimum ratio of frequencies of a given barcode pair and the most abundant 
@@ -225,6 +292,52 @@ def parse_args():
                         type=int
                         )
 
+    parser.add_argument('--prefetch-batches',
+                        dest='prefetch_batches',
+                        help='''The number of batches of fastq records to read ahead in a background 
+                        thread (0 - read records in the main thread)
+                        ''',
+                        default=0,
+                        type=int
+                        )
+
+    parser.add_argument('--extraction-cache-size',
+                        dest='extraction_cache_size',
+                        help='''The number of tag windows of reads whose barcode search results are
+                        cached, so that the primers are not searched for again in duplicated reads
+                        (0 - no cache). The cache is used for reads that are not processed in
+                        batches of reads of the same length. The hit rate is reported in the log
+                        ''',
+                        default=ExtractionCache.DEFAULT_SIZE,
+                        type=int
+                        )
+
+    parser.add_argument('--decompression-threads',
+                        dest='decompression_threads',
+                        help='''The number of threads used to decompress fastq files (if supported by 
+                        the compression format and the installed decompression program)
+                        ''',
+                        default=4,
+                        type=int
+                        )
+
+    parser.add_argument('--sample-name',
+                        dest='sample_name',
+                        help='''The name of the sample used to name output files instead of the name
+                        of the fastq file. It is required if fastq records are read from stdin (-i -)
+                        ''',
+                        type=str
+                        )
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        help='''The number of worker processes to process fastq files in parallel
+                        (the largest files are processed first) and to search for similar barcodes
+                        ''',
+                        default=1,
+                        type=int
+                        )
+
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(1)
@@ -233,37 +346,62 @@ def parse_args():
 
 
 def check_args(args):
-    pass
+    if args.input == util.STDIN and not args.sample_name:
+        sys.exit('The --sample-name parameter is required to read fastq records from stdin')
+
+    if args.sample_name and os.path.isdir(args.input):
+        sys.exit('The --sample-name parameter can not be used with a directory of fastq files')
+
+    if args.sim_max_distance < 1:
+        sys.exit('The --sim-max-distance parameter should be at least 1')
 
 
 def main():
     BarcodeStat.SIM_RATIO_THRESHOLD = Context.sim_ratio_threshold
+    BarcodeStat.SIM_MAX_DISTANCE = Context.sim_max_distance
+    BarcodeStat.SIM_INDELS = Context.sim_indels
     PairedBarcodeStat.CHIM_RATIO_THRESHOLD = Context.chim_ratio_threshold
 
-    up_barcodes = {}
-    dn_barcodes = {}
+    up_counter = BarcodeCounter()
+    dn_counter = BarcodeCounter()
     barcodes12 = {}
 
     logging.info("Processing fastq files started")
     util.process_fastq_files(Context.fastq_source,
-                             process_fastq_file, barcodes12, up_barcodes, dn_barcodes)
+                             process_fastq_file,
+                             workers=Context.workers,
+                             callback=lambda fastq_fname, results: merge_fastq_file_results(
+                                 fastq_fname, results, barcodes12, up_counter, dn_counter))
+
+    # the stats of up and down barcodes in columns, in the order of the counters
+    up_barcodes = PairedBarcodeStatTable(*up_counter.arrays())
+    dn_barcodes = PairedBarcodeStatTable(*dn_counter.arrays())
+
+    # the up <=> down adjacency of barcode pairs
+    barcode_pairs = BarcodePairs(barcodes12, up_barcodes.codes, dn_barcodes.codes)
 
     print('Analyze similar barcodes: up tags')
-    BarcodeStat.find_similar_barcodes(up_barcodes)
-    update_pair_counts(up_barcodes, barcodes12, 0)
-    PairedBarcodeStat.save_barcode_stats(
-        Context.barcode_up_stat_fname(), up_barcodes)
+    up_similar_pairs = up_barcodes.find_similar_barcodes(Context.workers)
+    up_barcodes.update_pair_reads_counts(barcode_pairs.up_adjacency)
+    up_barcodes.save_barcode_stats(Context.barcode_up_stat_fname())
+    if Context.cluster:
+        up_barcodes.save_barcode_clusters(
+            Context.barcode_up_cluster_fname(),
+            up_barcodes.cluster_barcodes(up_similar_pairs))
     # process_barcode_stat(up_barcodes)
 
     print('Analyze similar barcodes: down tags')
-    BarcodeStat.find_similar_barcodes(dn_barcodes)
-    update_pair_counts(dn_barcodes, barcodes12, 1)
-    PairedBarcodeStat.save_barcode_stats(
-        Context.barcode_dn_stat_fname(), dn_barcodes)
+    dn_similar_pairs = dn_barcodes.find_similar_barcodes(Context.workers)
+    dn_barcodes.update_pair_reads_counts(barcode_pairs.dn_adjacency)
+    dn_barcodes.save_barcode_stats(Context.barcode_dn_stat_fname())
+    if Context.cluster:
+        dn_barcodes.save_barcode_clusters(
+            Context.barcode_dn_cluster_fname(),
+            dn_barcodes.cluster_barcodes(dn_similar_pairs))
     # process_barcode_stat(dn_barcodes)
 
     print('Export results')
-    save_barcode_pair_stat(barcodes12, up_barcodes, dn_barcodes)
+    save_barcode_pair_stat(barcode_pairs, up_barcodes, dn_barcodes)
 
     logging.info("Done!")
 
@@ -284,28 +422,93 @@ def init_logger():
         datefmt="%m/%d/%Y %I:%M:%S %p")
 
 
-def process_fastq_file(fastq_fname, barcodes12, up_barcodes, dn_barcodes):
+def process_fastq_file(fastq_fname):
     ''' Process fastq file.
         1. Extracts barcode pairs
         2. Collect stats on barcode frequency and similar barcodes (that differs by 1 nucleotide)
+        Returns the file stat and the barcode pairs and barcodes collected from the file
     '''
     print("Doing file:%s" % fastq_fname)
 
+    up_counter = BarcodeCounter()
+    dn_counter = BarcodeCounter()
+    barcodes12 = {}
+
     fastq_file_stat = FastqFileStat()
     print("\tExtracting barcodes...")
-    extract_barcodes(fastq_fname, barcodes12, up_barcodes,
-                     dn_barcodes, fastq_file_stat)
+    extract_barcodes(fastq_fname, barcodes12, up_counter,
+                     dn_counter, fastq_file_stat)
+
+    return fastq_file_stat, barcodes12, up_counter, dn_counter
+
+
+def merge_fastq_file_results(fastq_fname, results, barcodes12, up_counter, dn_counter):
+    ''' Merges the barcode pairs and barcodes collected from a fastq file
+        into the barcode pairs and barcodes of all files
+    '''
+    fastq_file_stat, file_barcodes12, file_up_counter, file_dn_counter = results
 
     # Log the file stat
     logging.info("%s\t%s" % (fastq_fname, str(fastq_file_stat)))
+    for extraction_stat in fastq_file_stat.extraction_stats:
+        logging.info("%s\t%s" % (fastq_fname, extraction_stat))
 
+    for bpair_key, bpair_reads_count in file_barcodes12.items():
+        barcodes12[bpair_key] = barcodes12.get(bpair_key, 0) + bpair_reads_count
 
-def extract_barcodes(fastq_fname, barcodes12, up_barcodes, dn_barcodes, fastq_file_stat):
+    up_counter.merge(file_up_counter)
+    dn_counter.merge(file_dn_counter)
+
+
+def extract_barcodes(fastq_fname, barcodes12, up_counter, dn_counter, fastq_file_stat):
     ''' Extracts barcodes from fastq file based on the barcode_tag and primer_position_shifts.
         The list of barcodes is stored in the output_dir.
         The barcodes with good qaulity are collected in the barcode2stat for further processing.
     '''
 
+    # extract barcodes of both tags from batches of reads
+    tags_matcher = MultiTagMatcher([Context.up_tag, Context.dn_tag],
+                                   Context.primer_position_shifts,
+                                   cache_size=Context.extraction_cache_size)
+    empty_barcode_text = str(EMPTY_BARCODE)
+    min_barcode_quality = Context.min_barcode_quality
+
+    def extract_batch(batch):
+        barcodes = tags_matcher.extract_packed_barcodes(batch)
+
+        # both barcodes of high quality should be present for the downstream analysis
+        up_keys = []
+        dn_keys = []
+        for up_barcode, dn_barcode in barcodes:
+            if up_barcode and dn_barcode and up_barcode[1] >= min_barcode_quality \
+                    and dn_barcode[1] >= min_barcode_quality:
+                up_keys.append(up_barcode[0])
+                dn_keys.append(dn_barcode[0])
+        fastq_file_stat.barcode_extracted_reads_add(len(up_keys))
+
+        # count the barcode pairs and the barcodes of the batch at once
+        for bpair_key, bpair_reads_count in collections.Counter(zip(up_keys, dn_keys)).items():
+            barcodes12[bpair_key] = barcodes12.get(bpair_key, 0) + bpair_reads_count
+        up_counter.add(up_keys)
+        dn_counter.add(dn_keys)
+        return barcodes
+
+    def process_record(record, barcodes):
+
+        fastq_file_stat.total_reads_inc()
+
+        up_barcode, dn_barcode = barcodes
+        if not (up_barcode or dn_barcode):
+            return None
+
+        # store the extracted barcode pair
+        record_id = record.id.split(' ')[0]
+        line = "%s\t%s\t%s\n" % (record_id,
+                                  up_barcode[2] if up_barcode else empty_barcode_text,
+                                  dn_barcode[2] if dn_barcode else empty_barcode_text)
+
+        return (line,)
+
     # open a file to store the extracted barcodes
     with open(Context.barcodes_fname(fastq_fname), 'w') as f:
         # write a header
@@ -315,76 +518,38 @@ def extract_barcodes(fastq_fname, barcodes12, up_barcodes, dn_barcodes, fastq_fi
         ))
 
         try:
-            # Process each record from the fastq file
-            reader = FastqReader(fastq_fname)
-            record = FastqRecord()
-            while reader.next_record(record):
-
-                fastq_file_stat.total_reads_inc()
-
-                # try to extract a barcode from the sequence
-                up_barcode = Context.up_tag.extract_barcode(
-                    record, Context.primer_position_shifts)
-
-                dn_barcode = Context.dn_tag.extract_barcode(
-                    record, Context.primer_position_shifts)
-
-                if up_barcode or dn_barcode:
-                    # store the extracted barcode pair
-                    record_id = record.id.split(' ')[0]
-                    f.write("%s\t%s\t%s\n" %
-                            (record_id,
-                             up_barcode if up_barcode else EMPTY_BARCODE,
-                             dn_barcode if dn_barcode else EMPTY_BARCODE))
-
-                    # both barcodes should be present for the downstresam analysis
-                    if not (up_barcode and dn_barcode):
-                        continue
-
-                    # store high quality barcode pairs in barcode2stat dictionary for the downstream analysis
-                    if up_barcode.min_quality >= Context.min_barcode_quality \
-                            and dn_barcode.min_quality >= Context.min_barcode_quality:
-
-                        fastq_file_stat.barcode_extracted_reads_inc()
-
-                        up_key = up_barcode.sequence
-                        dn_key = dn_barcode.sequence
-                        bpair_key = up_key + Context.BARCODE_SEPARATOR + dn_key
-                        bpair_reads_count = barcodes12.get(bpair_key)
-
-                        up_stat = None
-                        dn_stat = None
-                        if bpair_reads_count:
-                            barcodes12[bpair_key] = bpair_reads_count + 1
-                            up_stat = up_barcodes[up_key]
-                            dn_stat = dn_barcodes[dn_key]
-                        else:
-                            barcodes12[bpair_key] = 1
-
-                            up_stat = up_barcodes.get(up_key)
-                            if not up_stat:
-                                up_stat = PairedBarcodeStat()
-                                up_barcodes[up_key] = up_stat
-
-                            dn_stat = dn_barcodes.get(dn_key)
-                            if not dn_stat:
-                                dn_stat = PairedBarcodeStat()
-                                dn_barcodes[dn_key] = dn_stat
-
-                        up_stat.reads_count_inc()
-                        dn_stat.reads_count_inc()
-
+            # Process each record from the fastq file: read, process records
+            # and write barcodes in parallel threads
+            reader = open_fastq_reader(fastq_fname, Context.prefetch_batches,
+                                       threads=Context.decompression_threads)
+            process_fastq_records(reader, process_record, [f], [extract_batch])
         finally:
             reader.close()
 
+    up_matcher, dn_matcher = tags_matcher.matchers
+    fastq_file_stat.add_extraction_stats(up_matcher, 'up')
+    fastq_file_stat.add_extraction_stats(dn_matcher, 'dn')
+
 
-def update_pair_counts(barcode_stat, barcodes12, barcode_index):
-    for bpair, bpair_count in barcodes12.items():
-        barcode = bpair.split(Context.BARCODE_SEPARATOR)[barcode_index]
-        barcode_stat[barcode].add_pair_reads_count(bpair_count)
+def save_barcode_pair_stat(barcode_pairs, up_barcodes, dn_barcodes):
+    ''' Saves the barcode pairs with the stats of their barcodes. The recommendation of all
+        pairs is computed at once from the arrays of recommendations of the barcodes,
+        and the stats of each barcode are formatted once
+    '''
+    up_recommended, up_pair_reads_counts_max = up_barcodes.recommendations()
+    dn_recommended, dn_pair_reads_counts_max = dn_barcodes.recommendations()
 
+    up_indices = barcode_pairs.up_indices
+    dn_indices = barcode_pairs.dn_indices
+    bpair_reads_counts = barcode_pairs.reads_counts
+    bpairs_recommended = up_recommended[up_indices] & dn_recommended[dn_indices] \
+        & (bpair_reads_counts >= up_pair_reads_counts_max[up_indices]) \
+        & (bpair_reads_counts >= dn_pair_reads_counts_max[dn_indices])
 
-def save_barcode_pair_stat(barcodes12, up_barcodes, dn_barcodes):
+    up_sequences = [util.unpack_sequence(barcode_code) for barcode_code in up_barcodes.codes]
+    dn_sequences = [util.unpack_sequence(barcode_code) for barcode_code in dn_barcodes.codes]
+    up_stats = up_barcodes.texts()
+    dn_stats = dn_barcodes.texts()
 
     # store barcode stat
     with open(Context.barcode_pair_stat_fname(), 'w') as f:
@@ -395,34 +560,19 @@ def save_barcode_pair_stat(barcodes12, up_barcodes, dn_barcodes):
             PairedBarcodeStat.header(prefix='dn_')
         ))
 
-        for bpair, bpair_reads_count in barcodes12.items():
-            up_barcode, dn_barcode = bpair.split(Context.BARCODE_SEPARATOR)
-            up_stat = up_barcodes[up_barcode]
-            dn_stat = dn_barcodes[dn_barcode]
-
-            bpair_recommended = True
-            if not up_stat.sim_recommended():
-                bpair_recommended = False
-            if not dn_stat.sim_recommended():
-                bpair_recommended = False
-
-            if not up_stat.chim_recommended():
-                bpair_recommended = False
-            if not dn_stat.chim_recommended():
-                bpair_recommended = False
-
-            if bpair_reads_count < up_stat.pair_reads_count_max:
-                bpair_recommended = False
-
-            if bpair_reads_count < dn_stat.pair_reads_count_max:
-                bpair_recommended = False
-
-            f.write("%s\t%s\t%s\t%s\t%s\t%s\n" % (
-                up_barcode, dn_barcode,
-                '+' if bpair_recommended else '-',
-                bpair_reads_count,
-                up_stat, dn_stat
-            ))
+        # write the pairs in chunks
+        for start in range(0, len(barcode_pairs), Context.BARCODE_PAIRS_CHUNK_SIZE):
+            end = start + Context.BARCODE_PAIRS_CHUNK_SIZE
+            f.write(''.join([
+                "%s\t%s\t%s\t%s\t%s\t%s\n" % (
+                    up_sequences[up_index], dn_sequences[dn_index],
+                    '+' if bpair_recommended else '-',
+                    bpair_reads_count,
+                    up_stats[up_index], dn_stats[dn_index])
+                for up_index, dn_index, bpair_recommended, bpair_reads_count in zip(
+                    up_indices[start:end].tolist(), dn_indices[start:end].tolist(),
+                    bpairs_recommended[start:end].tolist(),
+                    bpair_reads_counts[start:end].tolist())]))
 
 
 if __name__ == '__main__':
@@ -1,5 +1,9 @@
 import struct
+import collections
+import numpy as np
 from . import util
+from . import similarity
+from .pairs import PairAdjacency
 from .blat import BlatRecord
 
 
@@ -46,6 +50,8 @@ class BarcodeTag:
     def __init__(self, primer_seq1, primer_pos1, primer_seq2, primer_pos2):
         self.__primer1 = Primer(primer_seq1, primer_pos1)
         self.__primer2 = Primer(primer_seq2, primer_pos2)
+        # compiled matchers: {(pos_shifts, require_entire_primer2) => BarcodeMatcher}
+        self.__matchers = {}
 
     def __str__(self):
         return 'primer1: %s; primer2: %s' % (self.__primer1, self.__primer2)
@@ -70,15 +76,483 @@ class BarcodeTag:
     def tag_end(self):
         return self.primer2.pos + self.primer2.size
 
+    def compile(self, pos_shifts, require_entire_primer2=True, cache_size=0):
+        """ Returns a new matcher that finds the tag in a sequence in one pass.
+            Matchers are not shared, so that the statistics of each matcher (the shift
+            histogram and the cache) are collected for its own reads only
+        """
+        return BarcodeMatcher(self, pos_shifts, require_entire_primer2, cache_size)
+
     def extract_barcode(self, fastq_record, pos_shifts, require_entire_primer2=True):
-        barcode = None
-        for pos_shift in pos_shifts:
-            if self.check_primers(fastq_record.sequence, pos_shift, require_entire_primer2):
-                barcode = Barcode()
-                barcode(fastq_record, self, pos_shift)
-                break
+        key = (tuple(pos_shifts), require_entire_primer2)
+        matcher = self.__matchers.get(key)
+        if not matcher:
+            matcher = self.compile(pos_shifts, require_entire_primer2)
+            self.__matchers[key] = matcher
+        return matcher.extract_barcode(fastq_record)
+
+
+class ExtractionCache:
+    """ Bounded LRU cache of the shifts of the tag found in reads.
+
+    Amplicon reads are highly redundant, so the same tag window (the part of a read covering
+    both primers at all allowed shifts) is searched for many times. The shift of the tag
+    (or None if it is not found) depends on the window only, so it is cached by the window
+    sequence, and only the quality of the barcode is checked for each read.
+    """
+
+    DEFAULT_SIZE = 1 << 16
+
+    # marks the keys that are not in the cache
+    MISSING = object()
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.__size = size
+        self.__items = collections.OrderedDict()
+        self.__hits_count = 0
+        self.__lookups_count = 0
+
+    def __len__(self):
+        return len(self.__items)
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def hits_count(self):
+        return self.__hits_count
+
+    @property
+    def lookups_count(self):
+        return self.__lookups_count
+
+    @property
+    def hit_rate(self):
+        return self.__hits_count / self.__lookups_count if self.__lookups_count else 0.0
+
+    def get(self, key):
+        """ Returns the cached value or MISSING"""
+        self.__lookups_count += 1
+        value = self.__items.get(key, ExtractionCache.MISSING)
+        if value is not ExtractionCache.MISSING:
+            self.__hits_count += 1
+            self.__items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.__items[key] = value
+        if len(self.__items) > self.__size:
+            # evict the least recently used item
+            self.__items.popitem(last=False)
+
+    def __str__(self):
+        return 'hits: %s, lookups: %s, hit rate: %.1f%%, size: %s' % (
+            self.__hits_count, self.__lookups_count, self.hit_rate * 100, self.__size)
+
+
+class ShiftHistogram:
+    """ Counts of the primer position shifts at which a tag was found.
+    """
+
+    def __init__(self, pos_shifts):
+        # the shifts are kept in the order of preference
+        self.__counts = dict((pos_shift, 0) for pos_shift in pos_shifts)
+
+    def inc(self, pos_shift):
+        self.__counts[pos_shift] += 1
+
+    def add(self, pos_shifts):
+        """ Counts an array of shifts"""
+        values, counts = np.unique(pos_shifts, return_counts=True)
+        for pos_shift, count in zip(values.tolist(), counts.tolist()):
+            self.__counts[pos_shift] += count
+
+    @property
+    def total_count(self):
+        return sum(self.__counts.values())
+
+    def items(self):
+        """ Iterates over (shift, count) in the order of preference of the shifts"""
+        return self.__counts.items()
+
+    def most_common(self):
+        """ Returns the shifts ordered by their counts, the shifts with equal counts
+            are kept in the order of preference
+        """
+        return sorted(self.__counts, key=lambda pos_shift: -self.__counts[pos_shift])
+
+    def __str__(self):
+        total_count = self.total_count
+        return 'shifts: ' + ', '.join('%s: %s (%.1f%%)' % (
+            pos_shift, count, count * 100.0 / total_count if total_count else 0.0)
+            for pos_shift, count in self.__counts.items())
+
+
+class BarcodeMatcher:
+    """ Finds a barcode tag in sequences.
+
+    Instead of checking both primers at each allowed shift, the matcher searches for primer1
+    within the window covering all shifts once, derives the shift from the position found,
+    and checks primer2 only at that shift. If primer1 is found at several allowed shifts,
+    they are tried in the order of the shifts, so the result is the same as the one of
+    checking the shifts one by one.
+
+    If a cache size is defined, the shifts are cached by the tag window (see ExtractionCache).
+
+    The shifts at which the tag is found are counted (see ShiftHistogram). Batches of reads
+    are matched at the most frequent shifts first, and only the reads that are not matched
+    yet are checked at the next shifts. A read matched at a shift is checked at a preferred
+    shift that follows in this order only if the primers can be found at both shifts
+    in the same read, so the results do not depend on the order.
+    """
+
+    # the longest barcode packed into uint64 with the leading 1
+    __MAX_PACKED_SIZE = 31
+    # codes of nucleotides used to pack barcodes (4 for other symbols)
+    __NUCLEOTIDE_CODES = np.full(256, 4, dtype=np.uint64)
+    __NUCLEOTIDE_CODES[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.arange(4, dtype=np.uint64)
+
+    def __init__(self, barcode_tag, pos_shifts, require_entire_primer2=True, cache_size=0):
+        self.__barcode_tag = barcode_tag
+        self.__pos_shifts = list(pos_shifts)
+        self.__require_entire_primer2 = require_entire_primer2
+
+        # order of preference of each shift
+        self.__shift_ranks = {}
+        for pos_shift in reversed(self.__pos_shifts):
+            self.__shift_ranks[pos_shift] = self.__pos_shifts.index(pos_shift)
+
+        primer1 = barcode_tag.primer1
+        primer2 = barcode_tag.primer2
+        self.__primer1_sequence = primer1.sequence
+        self.__primer1_pos = primer1.pos
+        self.__primer2_sequence = primer2.sequence
+        self.__primer2_pos = primer2.pos
+        self.__primer2_size = primer2.size
+
+        if self.__pos_shifts:
+            self.__window_start = primer1.pos + min(self.__pos_shifts)
+            self.__window_end = primer1.pos + max(self.__pos_shifts) + primer1.size
+
+        # primers at negative positions are checked by slicing as before,
+        # since slices with negative indices are not equivalent to the search
+        self.__search = bool(self.__pos_shifts) and self.__window_start >= 0 \
+            and primer2.pos + min(self.__pos_shifts) >= 0
+
+        # to match batches of reads
+        self.__primer1_codes = np.frombuffer(primer1.sequence.encode('ascii'), dtype=np.uint8)
+        self.__primer2_codes = np.frombuffer(primer2.sequence.encode('ascii'), dtype=np.uint8)
+        self.__barcode_start = primer1.pos + primer1.size
+        self.__barcode_size = primer2.pos - self.__barcode_start
+
+        # the shift depends on the tag window only if the primers are searched for
+        self.__cache = None
+        if cache_size and self.__search:
+            self.__cache = ExtractionCache(cache_size)
+            self.__cache_window_end = primer2.pos + max(self.__pos_shifts) + primer2.size
+
+        self.__shift_histogram = ShiftHistogram(self.__pos_shifts)
+        # the order in which batches are matched, updated after each batch
+        self.__search_order = sorted(self.__shift_ranks, key=self.__shift_ranks.get)
+        # {shift => less preferred shifts, the reads matched at them are checked at the shift}
+        self.__overridden_shifts = {}
+        for pos_shift, rank in self.__shift_ranks.items():
+            self.__overridden_shifts[pos_shift] = [
+                other_shift for other_shift, other_rank in self.__shift_ranks.items()
+                if other_rank > rank and self.__primer1_overlaps(abs(pos_shift - other_shift))]
+
+    def __primer1_overlaps(self, distance):
+        # whether primer1 can be found twice in a sequence at the given distance
+        primer1 = self.__primer1_sequence
+        return distance >= len(primer1) or primer1[distance:] == primer1[:len(primer1) - distance]
+
+    @property
+    def cache(self):
+        """ ExtractionCache or None if the shifts are not cached"""
+        return self.__cache
+
+    @property
+    def shift_histogram(self):
+        return self.__shift_histogram
+
+    @property
+    def search_order(self):
+        """ The shifts in the order in which the next batch is matched"""
+        return self.__search_order
+
+    def find_shift(self, sequence):
+        """ Returns the shift of the primers found in the sequence or None"""
+        if self.__cache is None:
+            pos_shift = self.__find_shift(sequence)
+        else:
+            # the window is truncated by the end of short sequences, so its length
+            # defines the length of the sequence as well
+            key = sequence[self.__window_start: self.__cache_window_end]
+            pos_shift = self.__cache.get(key)
+            if pos_shift is ExtractionCache.MISSING:
+                pos_shift = self.__find_shift(sequence)
+                self.__cache.put(key, pos_shift)
+
+        if pos_shift is not None:
+            self.__shift_histogram.inc(pos_shift)
+        return pos_shift
+
+    def __find_shift(self, sequence):
+        if not self.__search:
+            for pos_shift in self.__pos_shifts:
+                if self.__barcode_tag.check_primers(sequence, pos_shift,
+                                                    self.__require_entire_primer2):
+                    return pos_shift
+            return None
+
+        start = sequence.find(self.__primer1_sequence, self.__window_start, self.__window_end)
+        if start < 0:
+            return None
+
+        # primer1 can be found more than once only if it is a periodic sequence
+        found_shifts = []
+        while start >= 0:
+            pos_shift = start - self.__primer1_pos
+            if pos_shift in self.__shift_ranks:
+                found_shifts.append(pos_shift)
+            start = sequence.find(self.__primer1_sequence, start + 1, self.__window_end)
+
+        if len(found_shifts) > 1:
+            found_shifts.sort(key=self.__shift_ranks.get)
+
+        for pos_shift in found_shifts:
+            if self.__check_primer2(sequence, pos_shift):
+                return pos_shift
+        return None
+
+    def __check_primer2(self, sequence, pos_shift):
+        pos_from = self.__primer2_pos + pos_shift
+        seq_len = len(sequence)
+        if pos_from >= seq_len:
+            return False
+
+        if pos_from + self.__primer2_size <= seq_len:
+            return sequence.startswith(self.__primer2_sequence, pos_from)
+
+        if self.__require_entire_primer2:
+            return False
+
+        # primer2 is truncated by the end of the sequence
+        return self.__primer2_sequence.startswith(sequence[pos_from:])
+
+    def extract_barcode(self, fastq_record):
+        """ Extracts barcode from the record
+        Args:
+            fastq_record: FastqRecord
+        Returns:
+            Barcode or None if the tag is not found
+        """
+        pos_shift = self.find_shift(fastq_record.sequence)
+        if pos_shift is None:
+            return None
+
+        barcode = Barcode()
+        barcode(fastq_record, self.__barcode_tag, pos_shift)
         return barcode
 
+    def extract_barcodes(self, batch, matrices=None):
+        """ Extracts barcodes from all records of a batch
+
+        If all reads of the batch have the same length, the primers are checked at each shift
+        for all reads at once on the matrix of sequences, and the barcodes with their qualities
+        are gathered from the matrices of sequences and qualities in one go. Otherwise, each
+        record is processed separately. The results are the same in both cases.
+
+        Args:
+            batch: FastqBatch
+            matrices: the result of batch_matrices(batch) if it is already known
+        Returns:
+            list with Barcode (or None if the tag is not found) for each record of the batch
+        """
+        matches = self.__match_batch(batch, matrices)
+        if matches is None:
+            return [self.extract_barcode(record) for record in batch]
+
+        barcodes = [None] * len(batch)
+        rows, positions, sequences_str, qualities_str, min_qualities = matches
+        size = self.__barcode_size
+        for i, (row, pos, min_quality) in enumerate(zip(rows, positions, min_qualities)):
+            barcodes[row] = Barcode.create(pos,
+                                           sequences_str[i * size: (i + 1) * size],
+                                           qualities_str[i * size: (i + 1) * size],
+                                           min_quality)
+        return barcodes
+
+    def extract_packed_barcodes(self, batch, matrices=None):
+        """ Extracts barcodes from all records of a batch as extract_barcodes does,
+            but without Barcode objects
+        Args:
+            batch: FastqBatch
+            matrices: the result of batch_matrices(batch) if it is already known
+        Returns:
+            list with (code, min_quality, text) (or None if the tag is not found) for each
+            record of the batch, where code is the packed sequence (see util.pack_sequence)
+            and text is the tab separated fields of the barcode (see Barcode.header)
+        """
+        matches = self.__match_batch(batch, matrices)
+        if matches is None:
+            values = []
+            for record in batch:
+                barcode = self.extract_barcode(record)
+                values.append((util.pack_sequence(barcode.sequence), barcode.min_quality,
+                               str(barcode)) if barcode else None)
+            return values
+
+        values = [None] * len(batch)
+        rows, positions, sequences_str, qualities_str, min_qualities = matches
+        size = self.__barcode_size
+        codes = self.__pack_barcodes(sequences_str, len(rows))
+        for i, (row, pos, code, min_quality) in enumerate(zip(rows, positions, codes,
+                                                              min_qualities)):
+            values[row] = (code, min_quality, '%s\t%s\t%s\t%s' % (
+                sequences_str[i * size: (i + 1) * size], pos,
+                qualities_str[i * size: (i + 1) * size], min_quality))
+        return values
+
+    @staticmethod
+    def batch_matrices(batch):
+        """ Returns the matrices of sequences and qualities of a batch, or None if they can
+            not be used to match the records of the batch at once
+        """
+        # the matrices can be used if the reads have the same length,
+        # and all symbols are ASCII (so that positions in bytes and in strings are the same)
+        if not len(batch) or batch.read_length is None:
+            return None
+        try:
+            sequences = batch.sequence_matrix()
+            qualities = batch.quality_matrix()
+        except ValueError:
+            return None
+        if sequences.max() >= 128 or qualities.max() >= 128:
+            return None
+        return sequences, qualities
+
+    def __match_batch(self, batch, matrices):
+        # returns the rows of the records with the tag found, the positions of the barcodes,
+        # their sequences and qualities joined into strings, and their minimal qualities,
+        # or None if the records should be processed separately
+        if not self.__search or self.__barcode_size <= 0:
+            return None
+        if matrices is None:
+            matrices = BarcodeMatcher.batch_matrices(batch)
+            if matrices is None:
+                return None
+
+        sequences, qualities = matrices
+        found, shifts = self.__find_shifts(sequences)
+        self.__shift_histogram.add(shifts[found])
+        self.__search_order = self.__shift_histogram.most_common()
+
+        rows = np.flatnonzero(found)
+        positions = self.__barcode_start + shifts[rows]
+        columns = positions[:, np.newaxis] + np.arange(self.__barcode_size)
+        barcode_qualities = qualities[rows[:, np.newaxis], columns]
+        min_qualities = Barcode.min_qualities(barcode_qualities)
+
+        sequences_str = sequences[rows[:, np.newaxis], columns].tobytes().decode('ascii')
+        qualities_str = barcode_qualities.tobytes().decode('ascii')
+        return (rows.tolist(), positions.tolist(), sequences_str, qualities_str,
+                min_qualities.tolist())
+
+    def __pack_barcodes(self, sequences_str, count):
+        # packs the joined barcodes as util.pack_sequence does
+        size = self.__barcode_size
+        if size > BarcodeMatcher.__MAX_PACKED_SIZE:
+            return [util.pack_sequence(sequences_str[i * size: (i + 1) * size])
+                    for i in range(count)]
+
+        nucleotides = BarcodeMatcher.__NUCLEOTIDE_CODES[np.frombuffer(
+            sequences_str.encode('ascii'), dtype=np.uint8).reshape(count, size)]
+        codes = np.ones(count, dtype=np.uint64)
+        for column in range(size):
+            codes = (codes << np.uint64(2)) | nucleotides[:, column]
+        codes = codes.tolist()
+
+        # the barcodes with other symbols (e.g. N) are packed one by one
+        for i in np.flatnonzero((nucleotides > 3).any(axis=1)).tolist():
+            codes[i] = util.pack_sequence(sequences_str[i * size: (i + 1) * size])
+        return codes
+
+    def __find_shifts(self, sequences):
+        found = np.zeros(len(sequences), dtype=bool)
+        shifts = np.zeros(len(sequences), dtype=np.int64)
+        for pos_shift in self.__search_order:
+            candidates = ~found
+            overridden_shifts = self.__overridden_shifts[pos_shift]
+            if overridden_shifts:
+                candidates |= found & np.isin(shifts, overridden_shifts)
+            rows = np.flatnonzero(candidates)
+            if not len(rows):
+                continue
+
+            matched = self.__match_primer(sequences, rows, self.__primer1_codes,
+                                          self.__primer1_pos + pos_shift, True)
+            if matched is None:
+                continue
+            rows = rows[matched]
+
+            matched = self.__match_primer(sequences, rows, self.__primer2_codes,
+                                          self.__primer2_pos + pos_shift,
+                                          self.__require_entire_primer2)
+            if matched is None:
+                continue
+            rows = rows[matched]
+
+            found[rows] = True
+            shifts[rows] = pos_shift
+        return found, shifts
+
+    @staticmethod
+    def __match_primer(sequences, rows, primer_codes, pos_from, require_entire_primer):
+        # returns a boolean array for the rows or None if the primer can not be found
+        # in any read
+        seq_len = sequences.shape[1]
+        if pos_from >= seq_len:
+            return None
+
+        pos_to = pos_from + len(primer_codes)
+        if pos_to > seq_len:
+            if require_entire_primer:
+                return None
+            primer_codes = primer_codes[:seq_len - pos_from]
+            pos_to = seq_len
+
+        if len(rows) == len(sequences):
+            return (sequences[:, pos_from:pos_to] == primer_codes).all(axis=1)
+        return (sequences[rows, pos_from:pos_to] == primer_codes).all(axis=1)
+
+
+class MultiTagMatcher:
+    """ Finds several barcode tags in the same reads.
+
+    The matrices of sequences and qualities of a batch are built once and shared by the
+    matchers of all tags, and the barcodes of all tags of a record are returned together.
+    """
+
+    def __init__(self, barcode_tags, pos_shifts, require_entire_primer2=True, cache_size=0):
+        self.__matchers = [barcode_tag.compile(pos_shifts, require_entire_primer2, cache_size)
+                           for barcode_tag in barcode_tags]
+
+    @property
+    def matchers(self):
+        return self.__matchers
+
+    def extract_packed_barcodes(self, batch):
+        """ Extracts barcodes of all tags from all records of a batch
+        Returns:
+            list with a tuple for each record of the batch, with (code, min_quality, text)
+            or None for each tag (see BarcodeMatcher.extract_packed_barcodes)
+        """
+        matrices = BarcodeMatcher.batch_matrices(batch)
+        return list(zip(*[matcher.extract_packed_barcodes(batch, matrices)
+                          for matcher in self.__matchers]))
+
 
 class Barcode:
     __BARCODE_SIZE = 20
@@ -92,6 +566,15 @@ class Barcode:
         self.__min_quality = 0
         # self.__hex_code = '-' * int(Barcode.__BARCODE_SIZE / 2)
 
+    @staticmethod
+    def create(pos, sequence, quality_str, min_quality):
+        barcode = Barcode()
+        barcode.__pos = pos
+        barcode.__sequence = sequence
+        barcode.__quality_str = quality_str
+        barcode.__min_quality = min_quality
+        return barcode
+
     def __call__(self, fastq_record, barcode_tag, pos_shift):
         pos_from = barcode_tag.primer1.pos + barcode_tag.primer1.size + pos_shift
         pos_to = barcode_tag.primer2.pos + pos_shift
@@ -134,12 +617,19 @@ class Barcode:
     #     return self.__hex_code
 
     def _min_quality(self, quality_str):
-        minQuality = Barcode.__MAX_QUALITY
-        for ch in quality_str:
-            quality = ord(ch) - Barcode.__QUALITY_CHAR_BASE
-            if quality < minQuality:
-                minQuality = quality
-        return minQuality
+        return Barcode.min_quality_of(quality_str)
+
+    @staticmethod
+    def min_quality_of(quality_str):
+        if not quality_str:
+            return Barcode.__MAX_QUALITY
+        return min(ord(min(quality_str)) - Barcode.__QUALITY_CHAR_BASE, Barcode.__MAX_QUALITY)
+
+    @staticmethod
+    def min_qualities(qualities):
+        """ Returns the minimal quality of each row of a matrix of quality symbols"""
+        min_qualities = qualities.min(axis=1).astype(np.int64) - Barcode.__QUALITY_CHAR_BASE
+        return np.minimum(min_qualities, Barcode.__MAX_QUALITY)
 
 
 EMPTY_BARCODE = Barcode()
@@ -147,6 +637,8 @@ EMPTY_BARCODE = Barcode()
 
 class BarcodeStat:
     SIM_RATIO_THRESHOLD = 2
+    SIM_MAX_DISTANCE = 1
+    SIM_INDELS = False
 
     __slots__ = ['__reads_count',
                  '__sim_reads_counts'
@@ -162,18 +654,17 @@ class BarcodeStat:
             'sim_reads_counts'
         ])
 
-    def __init__(self):
-        self.__reads_count = 0
+    def __init__(self, reads_count=0):
+        self.__reads_count = reads_count
         self.__sim_reads_counts = []
 
     def __str__(self):
-        return '\t'.join(str(x) for x in [
+        return '%s\t%s\t%s\t%s\t%s,' % (
             self.reads_count,
             '+' if self.sim_recommended() else '-',
             self.sim_reads_count,
             self.sim_reads_count_max,
-            ','.join(str(x) for x in self.__sim_reads_counts) + ','
-        ])
+            ','.join(map(str, self.__sim_reads_counts)))
 
     @property
     def reads_count(self):
@@ -194,34 +685,38 @@ class BarcodeStat:
         self.__sim_reads_counts.append(sim_reads_count)
 
     def sim_recommended(self):
-        return self.__reads_count >= self.sim_reads_count_max * BarcodeStat.SIM_RATIO_THRESHOLD
+        return BarcodeStat.sim_recommended_of(self.__reads_count, self.sim_reads_count_max)
 
     @staticmethod
-    def find_similar_barcodes(barcodes):
-        # update info about similar barcodes
-        for barcode_sequence, barcode_stat in barcodes.items():
-            barcode_sequence_chars = list(barcode_sequence)
-            util.process_similar_sequences(
-                barcode_sequence_chars,
-                BarcodeStat._process_similar_barcode,
-                barcode_stat,
-                barcodes)
+    def sim_recommended_of(reads_count, sim_reads_count_max):
+        ''' The similarity check of barcodes (the arguments are numbers or arrays)'''
+        return reads_count >= sim_reads_count_max * BarcodeStat.SIM_RATIO_THRESHOLD
 
     @staticmethod
-    def _process_similar_barcode(chars, barcode_stat, barcodes):
-        similar_barcode_key = ''.join(chars)
-        similar_barcode_stat = barcodes.get(similar_barcode_key)
-        if similar_barcode_stat:
-            barcode_stat.add_sim_reads_count(similar_barcode_stat.reads_count)
-            # barcode_stat.sim_reads_count += similar_barcode_stat.reads_count
+    def find_similar_barcodes(barcodes, workers=1):
+        ''' Updates info about similar barcodes (within SIM_MAX_DISTANCE substitutions,
+            or one indel if SIM_INDELS is set)
+        Args:
+            barcodes: {packed barcode sequence (see util.pack_sequence) => BarcodeStat}
+            workers: the number of processes to search for similar barcodes
+        Returns:
+            (indices, similar_indices): arrays with pairs of indices of similar barcodes
+            (in the order of barcodes)
+        '''
+        barcode_stats = list(barcodes.values())
+        indices, similar_indices = similarity.similar_code_pairs(
+            list(barcodes.keys()), BarcodeStat.SIM_MAX_DISTANCE, workers, BarcodeStat.SIM_INDELS)
+        for index, similar_index in zip(indices.tolist(), similar_indices.tolist()):
+            barcode_stats[index].add_sim_reads_count(barcode_stats[similar_index].reads_count)
+        return indices, similar_indices
 
     @staticmethod
     def save_barcode_stats(file_name, barcodes):
         with open(file_name, 'w') as f:
             # write a header
             f.write("%s\t%s\n" % ('barcode', BarcodeStat.header()))
-            for barcode_sequence, barcode_stat in barcodes.items():
-                f.write("%s\t%s\n" % (barcode_sequence, str(barcode_stat)))
+            for barcode_code, barcode_stat in barcodes.items():
+                f.write("%s\t%s\n" % (util.unpack_sequence(barcode_code), str(barcode_stat)))
 
 
 class PairedBarcodeStat(BarcodeStat):
@@ -238,28 +733,37 @@ class PairedBarcodeStat(BarcodeStat):
             'pair_reads_counts'
         ])
 
-    def __init__(self):
-        BarcodeStat.__init__(self)
+    def __init__(self, reads_count=0):
+        BarcodeStat.__init__(self, reads_count)
         self.__pair_reads_counts = []
 
     def __str__(self):
-        return BarcodeStat.__str__(self) + '\t' + '\t'.join(str(x) for x in [
+        return '%s\t%s\t%s\t%s\t%s,' % (
+            BarcodeStat.__str__(self),
             '+' if self.chim_recommended() else '-',
             self.pair_reads_count_max,
             self.pair_reads_count_submax,
-            ','.join(str(x) for x in self.__pair_reads_counts) + ','
-        ])
+            ','.join(map(str, self.__pair_reads_counts)))
 
     def chim_recommended(self):
-        return self.pair_reads_count_max >= self.pair_reads_count_submax * PairedBarcodeStat.CHIM_RATIO_THRESHOLD
+        return PairedBarcodeStat.chim_recommended_of(self.pair_reads_count_max,
+                                                     self.pair_reads_count_submax)
+
+    @staticmethod
+    def chim_recommended_of(pair_reads_count_max, pair_reads_count_submax):
+        ''' The chimera check of barcodes (the arguments are numbers or arrays)'''
+        return pair_reads_count_max >= pair_reads_count_submax * PairedBarcodeStat.CHIM_RATIO_THRESHOLD
 
     def add_pair_reads_count(self, pair_reads_count):
         self.__pair_reads_counts.append(pair_reads_count)
 
+    @property
+    def pair_reads_counts(self):
+        return self.__pair_reads_counts
+
     @property
     def pair_reads_count_max(self):
-        # if self.__pair_reads_counts else 0
-        return max(self.__pair_reads_counts)
+        return max(self.__pair_reads_counts) if self.__pair_reads_counts else 0
 
     @property
     def pair_reads_count_submax(self):
@@ -278,8 +782,8 @@ class PairedBarcodeStat(BarcodeStat):
         with open(file_name, 'w') as f:
             # write a header
             f.write("%s\t%s\n" % ('barcode', PairedBarcodeStat.header()))
-            for barcode_sequence, barcode_stat in barcodes.items():
-                f.write("%s\t%s\n" % (barcode_sequence, str(barcode_stat)))
+            for barcode_code, barcode_stat in barcodes.items():
+                f.write("%s\t%s\n" % (util.unpack_sequence(barcode_code), str(barcode_stat)))
 
         # class BarcodeStat:
         #     """ To store barcode statistics
@@ -361,6 +865,164 @@ class PairedBarcodeStat(BarcodeStat):
         #                 f.write("%s\t%s\n" % (barcode_sequence, str(barcode_stat)))
 
 
+class BarcodeStatTable:
+    ''' Stats of all barcodes (e.g. counted by BarcodeCounter) kept in columns rather than
+        in a BarcodeStat object for each barcode: the codes and the reads counts of the
+        barcodes, and the adjacency of similar barcodes (see pairs.PairAdjacency), so that
+        the stats of all barcodes are computed at once. The stats are formatted as
+        BarcodeStat formats them
+    '''
+
+    def __init__(self, codes, reads_counts):
+        '''
+        Args:
+            codes: list of distinct packed sequences (see util.pack_sequence)
+            reads_counts: int64 array with the reads count of each barcode
+        '''
+        self.__codes = codes
+        self.__reads_counts = np.asarray(reads_counts, dtype=np.int64)
+        self.__sim_adjacency = BarcodeStatTable._empty_adjacency(len(codes))
+
+    def __len__(self):
+        return len(self.__codes)
+
+    @staticmethod
+    def header(prefix='', sep='\t'):
+        return BarcodeStat.header(prefix, sep)
+
+    @staticmethod
+    def _empty_adjacency(size):
+        no_pairs = np.zeros(0, dtype=np.int64)
+        return PairAdjacency(no_pairs, no_pairs, no_pairs, size)
+
+    @property
+    def codes(self):
+        return self.__codes
+
+    @property
+    def reads_counts(self):
+        return self.__reads_counts
+
+    def find_similar_barcodes(self, workers=1):
+        ''' Finds similar barcodes as BarcodeStat.find_similar_barcodes does, and keeps the
+            reads counts of the similar barcodes of each barcode
+        Returns:
+            (indices, similar_indices): arrays with pairs of indices of similar barcodes
+        '''
+        indices, similar_indices = similarity.similar_code_pairs(
+            self.__codes, BarcodeStat.SIM_MAX_DISTANCE, workers, BarcodeStat.SIM_INDELS)
+        self.__sim_adjacency = PairAdjacency(indices, similar_indices,
+                                             self.__reads_counts[similar_indices], len(self))
+        return indices, similar_indices
+
+    def sim_recommended(self):
+        ''' Returns a bool array with the barcodes that pass the similarity check'''
+        return BarcodeStat.sim_recommended_of(self.__reads_counts,
+                                              self.__sim_adjacency.reads_counts_max())
+
+    def cluster_barcodes(self, similar_pairs):
+        ''' Clusters barcodes in the order of decreasing abundance: a barcode absorbs
+            its similar barcodes if it is at least SIM_RATIO_THRESHOLD times more abundant
+            (see similarity.abundance_clusters)
+        Args:
+            similar_pairs: (indices, similar_indices) returned by find_similar_barcodes
+        Returns:
+            int64 array with the index of the parent barcode of each barcode
+        '''
+        indices, similar_indices = similar_pairs
+        return similarity.abundance_clusters(indices, similar_indices, self.__reads_counts,
+                                             BarcodeStat.SIM_RATIO_THRESHOLD)
+
+    def save_barcode_clusters(self, file_name, parents):
+        ''' Saves the clusters of barcodes (see cluster_barcodes): a parent barcode of
+            each barcode, and total reads count and the number of barcodes of its cluster
+        '''
+        barcode_codes = self.__codes
+        cluster_reads_counts = np.bincount(parents, weights=self.__reads_counts,
+                                           minlength=len(parents)).astype(np.int64).tolist()
+        cluster_sizes = np.bincount(parents, minlength=len(parents)).tolist()
+
+        with open(file_name, 'w') as f:
+            f.write('\t'.join(['barcode', 'reads_count', 'cluster_barcode',
+                               'cluster_reads_count', 'cluster_size']) + '\n')
+            for barcode_code, reads_count, parent in zip(
+                    barcode_codes, self.__reads_counts.tolist(), parents.tolist()):
+                f.write("%s\t%s\t%s\t%s\t%s\n" % (
+                    util.unpack_sequence(barcode_code), reads_count,
+                    util.unpack_sequence(barcode_codes[parent]),
+                    cluster_reads_counts[parent], cluster_sizes[parent]))
+
+    def texts(self):
+        ''' Returns a list with the stats of each barcode formatted as str(BarcodeStat)'''
+        sim_adjacency = self.__sim_adjacency
+        return ['%s\t%s\t%s\t%s\t%s,' % (
+            reads_count, '+' if sim_recommended else '-', sim_reads_count,
+            sim_reads_count_max, ','.join(map(str, sim_reads_counts)))
+            for reads_count, sim_recommended, sim_reads_count, sim_reads_count_max,
+            sim_reads_counts in zip(
+                self.__reads_counts.tolist(), self.sim_recommended().tolist(),
+                sim_adjacency.reads_counts_sum().tolist(),
+                sim_adjacency.reads_counts_max().tolist(),
+                sim_adjacency.rows_reads_counts())]
+
+    def save_barcode_stats(self, file_name):
+        with open(file_name, 'w') as f:
+            # write a header
+            f.write("%s\t%s\n" % ('barcode', self.header()))
+            for barcode_code, text in zip(self.__codes, self.texts()):
+                f.write("%s\t%s\n" % (util.unpack_sequence(barcode_code), text))
+
+
+class PairedBarcodeStatTable(BarcodeStatTable):
+    ''' Stats of all barcodes of barcode pairs in columns (see BarcodeStatTable) with the
+        adjacency of the paired barcodes. The stats are formatted as PairedBarcodeStat
+        formats them
+    '''
+
+    def __init__(self, codes, reads_counts):
+        BarcodeStatTable.__init__(self, codes, reads_counts)
+        self.__pair_adjacency = BarcodeStatTable._empty_adjacency(len(codes))
+
+    @staticmethod
+    def header(prefix='', sep='\t'):
+        return PairedBarcodeStat.header(prefix, sep)
+
+    def update_pair_reads_counts(self, pair_adjacency):
+        ''' Sets the reads counts of the pairs of each barcode
+        Args:
+            pair_adjacency: PairAdjacency with a row for each barcode in the order of barcodes
+                (see pairs.BarcodePairs)
+        '''
+        self.__pair_adjacency = pair_adjacency
+
+    def recommendations(self):
+        ''' Checks the similarity and the chimera recommendations of all barcodes at once
+        Returns:
+            (recommended, pair_reads_counts_max): bool array with the barcodes that pass both
+            checks, and int64 array with the maximal reads count of the pairs of each barcode
+        '''
+        pair_reads_counts_max = self.__pair_adjacency.reads_counts_max()
+        recommended = self.sim_recommended() & PairedBarcodeStat.chim_recommended_of(
+            pair_reads_counts_max, self.__pair_adjacency.reads_counts_submax())
+        return recommended, pair_reads_counts_max
+
+    def texts(self):
+        ''' Returns a list with the stats of each barcode formatted as str(PairedBarcodeStat)'''
+        pair_adjacency = self.__pair_adjacency
+        pair_reads_counts_max = pair_adjacency.reads_counts_max()
+        pair_reads_counts_submax = pair_adjacency.reads_counts_submax()
+        chim_recommended = PairedBarcodeStat.chim_recommended_of(
+            pair_reads_counts_max, pair_reads_counts_submax)
+        return ['%s\t%s\t%s\t%s\t%s,' % (
+            text, '+' if recommended else '-', pair_reads_count_max, pair_reads_count_submax,
+            ','.join(map(str, pair_reads_counts)))
+            for text, recommended, pair_reads_count_max, pair_reads_count_submax,
+            pair_reads_counts in zip(
+                BarcodeStatTable.texts(self), chim_recommended.tolist(),
+                pair_reads_counts_max.tolist(), pair_reads_counts_submax.tolist(),
+                pair_adjacency.rows_reads_counts())]
+
+
 class BarcodeLocation(BarcodeStat):
     LOC_RATIO_THRESHOLD = 0.3
 
@@ -444,8 +1106,8 @@ class BarcodeLocation(BarcodeStat):
             f.write("%s\t%s\n" % ('barcode', BarcodeLocation.header()))
 
             # write all barcodes
-            for barcode, barcode_location in barcodes_locations.items():
-                f.write("%s\t%s\n" % (barcode, str(barcode_location)))
+            for barcode_code, barcode_location in barcodes_locations.items():
+                f.write("%s\t%s\n" % (util.unpack_sequence(barcode_code), str(barcode_location)))
 
 
 class BarcodeHits:
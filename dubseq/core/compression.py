@@ -0,0 +1,235 @@
+""" Registry of compression formats of input files
+
+Each format (codec) knows its file name extensions and magic bytes, and how to decompress
+a file. External decompression programs are preferred (multi-threaded ones first), since
+they run in parallel with the python process. If none of the programs is installed, the
+file is decompressed in-process by the corresponding python module.
+"""
+
+import os
+import io
+import shutil
+import subprocess
+import threading
+
+try:
+    # optional dependency, used only if the zstd program is not installed
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class CompressionCodec:
+    """ Describes a compression format
+
+    Attributes:
+        name: name of the format
+        extensions: file name extensions of the compressed files
+        magic: the first bytes of compressed files
+        commands: templates of commands to decompress a file to stdout in the order of
+            preference. The {threads} placeholder is replaced by the number of threads
+        python_opener: function to open a compressed file (or a binary stream with
+            compressed data) as a binary stream in-process
+    """
+
+    THREADS = min(4, os.cpu_count() or 1)
+
+    def __init__(self, name, extensions, magic, commands, python_opener=None):
+        self.__name = name
+        self.__extensions = tuple(extensions)
+        self.__magic = magic
+        self.__commands = commands
+        self.__python_opener = python_opener
+
+    def __str__(self):
+        return self.__name
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def extensions(self):
+        return self.__extensions
+
+    @property
+    def magic(self):
+        return self.__magic
+
+    def matches_header(self, header):
+        return header.startswith(self.__magic)
+
+    def command(self, threads=None):
+        """ Returns the first available command to decompress a file, or None"""
+        threads = threads or CompressionCodec.THREADS
+        for template in self.__commands:
+            if shutil.which(template[0]):
+                return [x.format(threads=threads) for x in template]
+        return None
+
+    def open(self, source, buffer_size=io.DEFAULT_BUFFER_SIZE, threads=None):
+        """ Opens a compressed file or stream for reading
+        Args:
+            source: name of the compressed file, or a binary stream with compressed data
+                (e.g. stdin or a named pipe)
+            buffer_size: size of the buffer of the stream
+            threads: the number of decompression threads (if supported by the program)
+        Returns:
+            (stream, process): binary stream with decompressed data, and the
+            decompression process (None if the data are decompressed in-process)
+        Raises:
+            IOError: occurs when neither a program nor a python module is available
+        """
+        is_file_name = isinstance(source, str)
+        command = self.command(threads)
+        if command and is_file_name:
+            process = subprocess.Popen(command + [source],
+                                       stdout=subprocess.PIPE,
+                                       bufsize=buffer_size)
+            return process.stdout, process
+
+        if command:
+            # compressed data are passed to the program by a separate thread
+            process = subprocess.Popen(command,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       bufsize=buffer_size)
+            feeder = threading.Thread(target=_feed, args=(source, process.stdin))
+            feeder.daemon = True
+            feeder.start()
+            return process.stdout, process
+
+        if self.__python_opener:
+            stream = self.__python_opener(source)
+            if not isinstance(stream, io.BufferedIOBase):
+                stream = io.BufferedReader(stream, buffer_size)
+            return stream, None
+
+        raise IOError('Can not decompress %s: no program or python module for %s format'
+                      % (source if is_file_name else 'stream', self.__name))
+
+
+def _feed(source, sink):
+    try:
+        shutil.copyfileobj(source, sink)
+    except (IOError, ValueError):
+        # the program was terminated before the end of the data
+        pass
+    finally:
+        try:
+            sink.close()
+        except IOError:
+            pass
+
+
+class BgzfCodec(CompressionCodec):
+    """ BGZF (blocked gzip) format produced by bgzip. BGZF files are valid gzip files,
+    so the gzip programs are used if bgzip is not installed.
+    """
+
+    def matches_header(self, header):
+        # gzip header with FEXTRA flag and BC subfield
+        return header.startswith(self.magic) and len(header) >= 14 \
+            and header[3] & 4 and header[12:14] == b'BC'
+
+
+def _open_gzip(source):
+    import gzip
+    return gzip.open(source, 'rb')
+
+
+def _open_bz2(source):
+    import bz2
+    return bz2.open(source, 'rb')
+
+
+def _open_xz(source):
+    import lzma
+    return lzma.open(source, 'rb')
+
+
+def _open_zstd(source):
+    if zstandard is None:
+        raise IOError('Can not decompress zstd data: neither zstd program nor '
+                      'zstandard module is installed')
+    if isinstance(source, str):
+        source = open(source, 'rb')
+    return zstandard.ZstdDecompressor().stream_reader(source, closefd=True)
+
+
+__GZIP_COMMANDS = [
+    ['pigz', '-dc', '-p', '{threads}'],
+    ['gunzip', '-c'],
+    ['gzip', '-dc']
+]
+
+GZIP = CompressionCodec('gz', ['.gz'], b'\x1f\x8b', __GZIP_COMMANDS, _open_gzip)
+
+BGZF = BgzfCodec('bgzf', ['.bgz', '.bgzf'], b'\x1f\x8b',
+                 [['bgzip', '-dc', '-@', '{threads}']] + __GZIP_COMMANDS, _open_gzip)
+
+ZSTD = CompressionCodec('zst', ['.zst', '.zstd'], b'\x28\xb5\x2f\xfd',
+                        [['zstd', '-dcq', '-T{threads}'], ['unzstd', '-cq']], _open_zstd)
+
+BZ2 = CompressionCodec('bz2', ['.bz2'], b'BZh',
+                       [['lbzip2', '-dc', '-n', '{threads}'],
+                        ['pbzip2', '-dc', '-p{threads}'],
+                        ['bzip2', '-dc']], _open_bz2)
+
+XZ = CompressionCodec('xz', ['.xz'], b'\xfd7zXZ\x00',
+                      [['xz', '-dc', '-T{threads}']], _open_xz)
+
+# the order matters for the detection by magic bytes: more specific formats go first
+CODECS = [BGZF, GZIP, ZSTD, BZ2, XZ]
+
+HEADER_SIZE = 16
+
+
+def register_codec(codec, first=False):
+    """ Registers a new compression format"""
+    if first:
+        CODECS.insert(0, codec)
+    else:
+        CODECS.append(codec)
+
+
+def compressed_extensions():
+    """ Returns extensions of all registered compression formats"""
+    extensions = []
+    for codec in CODECS:
+        for extension in codec.extensions:
+            if extension not in extensions:
+                extensions.append(extension)
+    return extensions
+
+
+def find_codec(file_name):
+    """ Finds the compression format of a file by the extension of its name and
+    the magic bytes at the start of the file
+    Returns:
+        CompressionCodec or None if the file is not compressed
+    """
+    codec = None
+    for _codec in CODECS:
+        if file_name.endswith(_codec.extensions):
+            codec = _codec
+            break
+
+    # named pipes can not be read twice, so only regular files are checked
+    if os.path.isfile(file_name):
+        with open(file_name, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        # the magic bytes can point to a more specific format (e.g. BGZF file with .gz extension)
+        header_codec = find_codec_by_header(header)
+        if header_codec and (codec is None or header_codec.magic == codec.magic):
+            codec = header_codec
+
+    return codec
+
+
+def find_codec_by_header(header):
+    """ Finds the compression format by the first bytes of a file"""
+    for codec in CODECS:
+        if codec.matches_header(header):
+            return codec
+    return None
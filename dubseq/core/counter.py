@@ -0,0 +1,267 @@
+""" Counting of packed barcodes in numpy arrays
+
+The counter is an open addressing hash table with linear probing. The keys are packed
+barcode sequences (see util.pack_sequence) stored in a uint64 array, the counts are stored
+in a uint32 array. A barcode takes 16 bytes per slot (including the order in which the
+barcodes were added), compared to a few hundred bytes taken by a dict entry with a
+BarcodeStat object.
+"""
+
+import numpy as np
+
+
+class BarcodeCounter:
+    """ Counts reads of packed barcodes
+
+    The codes can be added in batches (add), or one by one (inc). Single codes are buffered
+    and added in batches. Barcodes are reported in the order they were first added.
+    Packed sequences that do not fit into uint64 (e.g. sequences with Ns, see
+    util.pack_sequence) are counted in a dict.
+    """
+
+    INITIAL_CAPACITY = 1 << 16
+    MAX_LOAD_FACTOR = 0.5
+    BUFFER_SIZE = 1 << 16
+
+    # packed sequences are never 0 because of the leading 1
+    __EMPTY_KEY = 0
+    __HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+    __MAX_KEY = (1 << 64) - 1
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        capacity_bits = max(int(capacity) - 1, 1).bit_length()
+        self.__init_table(capacity_bits)
+        self.__size = 0
+        self.__next_order = 0
+        # {code => [order, count]} for codes that do not fit into the table
+        self.__escaped = {}
+        # codes added by inc, but not yet counted
+        self.__buffer = []
+
+    def __init_table(self, capacity_bits):
+        capacity = 1 << capacity_bits
+        self.__capacity_bits = capacity_bits
+        self.__keys = np.zeros(capacity, dtype=np.uint64)
+        self.__counts = np.zeros(capacity, dtype=np.uint32)
+        self.__orders = np.zeros(capacity, dtype=np.uint32)
+
+    def __len__(self):
+        self.flush()
+        return self.__size + len(self.__escaped)
+
+    @property
+    def capacity(self):
+        return len(self.__keys)
+
+    def inc(self, code):
+        """ Counts one read of a barcode (the code is buffered)"""
+        self.__buffer.append(code)
+        if len(self.__buffer) >= BarcodeCounter.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        """ Counts the buffered codes"""
+        if self.__buffer:
+            buffer = self.__buffer
+            self.__buffer = []
+            self.__add_codes(buffer)
+
+    def add(self, codes, counts=None):
+        """ Counts a batch of barcodes
+        Args:
+            codes: packed sequences (array or list of ints)
+            counts: the number of reads of each barcode (1 by default)
+        """
+        self.flush()
+        self.__add_codes(codes, counts)
+
+    def merge(self, counter):
+        """ Adds counts of another counter. New barcodes are added in the order
+            they were added to the other counter
+        """
+        codes, counts = counter.arrays()
+        self.add(codes, counts.tolist())
+
+    def get(self, code, default=0):
+        """ Returns the count of a barcode"""
+        self.flush()
+        if not self.__fits(code):
+            value = self.__escaped.get(code)
+            return value[1] if value else default
+
+        key = np.uint64(code)
+        mask = self.capacity - 1
+        slot = int(self.__hash(np.array([key]))[0])
+        while True:
+            table_key = self.__keys[slot]
+            if table_key == key:
+                return int(self.__counts[slot])
+            if table_key == BarcodeCounter.__EMPTY_KEY:
+                return default
+            slot = (slot + 1) & mask
+
+    def items(self):
+        """ Iterates over (code, count) of all barcodes in the order they were added"""
+        codes, counts = self.arrays()
+        return zip(codes, counts.tolist())
+
+    def arrays(self):
+        """ Exports all barcodes in the order they were added
+        Returns:
+            (codes, counts): list of codes and int64 array of the corresponding counts
+        """
+        self.flush()
+        slots = np.flatnonzero(self.__keys != BarcodeCounter.__EMPTY_KEY)
+        slots = slots[np.argsort(self.__orders[slots], kind='stable')]
+        codes = self.__keys[slots].tolist()
+        counts = self.__counts[slots].astype(np.int64)
+        if not self.__escaped:
+            return codes, counts
+
+        # put the escaped codes at their places
+        orders = np.concatenate([self.__orders[slots].astype(np.int64),
+                                 [order for order, _ in self.__escaped.values()]])
+        order = np.argsort(orders, kind='stable')
+        codes.extend(self.__escaped)
+        counts = np.concatenate([counts, [count for _, count in self.__escaped.values()]])
+        return [codes[i] for i in order.tolist()], counts[order].astype(np.int64)
+
+    def sorted_arrays(self):
+        """ Exports the barcodes counted in the table
+        Returns:
+            (codes, counts): uint64 array of codes sorted in ascending order and uint32 array
+            of the corresponding counts. The escaped codes (see escaped_counts) are not included
+        """
+        self.flush()
+        codes = self.__keys[self.__keys != BarcodeCounter.__EMPTY_KEY]
+        counts = self.__counts[self.__keys != BarcodeCounter.__EMPTY_KEY]
+        order = np.argsort(codes)
+        return codes[order], counts[order]
+
+    def escaped_counts(self):
+        """ Returns {code => count} for codes that are not stored in the table"""
+        self.flush()
+        return dict((code, count) for code, (_, count) in self.__escaped.items())
+
+    @staticmethod
+    def __fits(code):
+        return isinstance(code, (int, np.integer)) and 0 < code <= BarcodeCounter.__MAX_KEY
+
+    def __add_codes(self, codes, counts=None):
+        if isinstance(codes, np.ndarray) and codes.dtype == np.uint64:
+            self.__add_keys(codes, counts)
+            return
+
+        try:
+            keys = np.array(codes, dtype=np.uint64)
+        except (OverflowError, TypeError, ValueError):
+            keys = None
+        if keys is not None and keys.ndim == 1 and BarcodeCounter.__EMPTY_KEY not in keys:
+            self.__add_keys(keys, counts)
+            return
+
+        # split the codes into runs of codes that fit (or do not fit) into the table
+        # to keep the order of new barcodes
+        counts = [1] * len(codes) if counts is None else list(counts)
+        start = 0
+        while start < len(codes):
+            fits = self.__fits(codes[start])
+            end = start + 1
+            while end < len(codes) and self.__fits(codes[end]) == fits:
+                end += 1
+            if fits:
+                self.__add_keys(np.array(codes[start:end], dtype=np.uint64), counts[start:end])
+            else:
+                for code, count in zip(codes[start:end], counts[start:end]):
+                    self.__add_escaped(code, count)
+            start = end
+
+    def __add_escaped(self, code, count):
+        value = self.__escaped.get(code)
+        if value:
+            value[1] += count
+        else:
+            self.__escaped[code] = [self.__next_order, count]
+            self.__next_order += 1
+
+    def __add_keys(self, keys, counts=None):
+        if not len(keys):
+            return
+
+        # unique keys in the order of their first occurrence
+        unique_keys, first_indices, inverse = np.unique(
+            keys, return_index=True, return_inverse=True)
+        if counts is None:
+            key_counts = np.bincount(inverse, minlength=len(unique_keys))
+        else:
+            key_counts = np.zeros(len(unique_keys), dtype=np.uint64)
+            np.add.at(key_counts, inverse, np.asarray(counts, dtype=np.uint64))
+        order = np.argsort(first_indices, kind='stable')
+        unique_keys = unique_keys[order]
+        key_counts = key_counts[order]
+
+        self.__reserve(len(unique_keys))
+        slots, is_new = self.__find_slots(unique_keys)
+        self.__counts[slots] += key_counts.astype(np.uint32)
+
+        new_slots = slots[is_new]
+        self.__orders[new_slots] = np.arange(
+            self.__next_order, self.__next_order + len(new_slots), dtype=np.uint32)
+        self.__next_order += len(new_slots)
+        self.__size += len(new_slots)
+
+    def __hash(self, keys):
+        # multiplicative hashing: the high bits of the product are the slot
+        return ((keys * BarcodeCounter.__HASH_MULTIPLIER)
+                >> np.uint64(64 - self.__capacity_bits)).astype(np.int64)
+
+    def __find_slots(self, keys):
+        """ Finds the slots of unique keys, new keys are put into empty slots
+        Returns:
+            (slots, is_new): arrays with a slot of each key and flags of new keys
+        """
+        mask = self.capacity - 1
+        slots = self.__hash(keys)
+        is_new = np.zeros(len(keys), dtype=bool)
+
+        pending = np.arange(len(keys))
+        while len(pending):
+            pending_slots = slots[pending]
+            table_keys = self.__keys[pending_slots]
+
+            found = table_keys == keys[pending]
+            empty = table_keys == BarcodeCounter.__EMPTY_KEY
+
+            # if several new keys go to the same empty slot, the first one takes it
+            # and the others will probe the next slots
+            candidates = pending[empty]
+            _, first_indices = np.unique(slots[candidates], return_index=True)
+            winners = candidates[first_indices]
+            self.__keys[slots[winners]] = keys[winners]
+            is_new[winners] = True
+
+            done = found.copy()
+            done[np.flatnonzero(empty)[first_indices]] = True
+            collided = ~(found | empty)
+            slots[pending[collided]] = (slots[pending[collided]] + 1) & mask
+            pending = pending[~done]
+
+        return slots, is_new
+
+    def __reserve(self, new_keys_count):
+        capacity_bits = self.__capacity_bits
+        max_size = self.__size + new_keys_count
+        while max_size > (1 << capacity_bits) * BarcodeCounter.MAX_LOAD_FACTOR:
+            capacity_bits += 1
+        if capacity_bits == self.__capacity_bits:
+            return
+
+        occupied = self.__keys != BarcodeCounter.__EMPTY_KEY
+        keys = self.__keys[occupied]
+        counts = self.__counts[occupied]
+        orders = self.__orders[occupied]
+
+        self.__init_table(capacity_bits)
+        slots, _ = self.__find_slots(keys)
+        self.__counts[slots] = counts
+        self.__orders[slots] = orders
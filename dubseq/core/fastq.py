@@ -4,15 +4,18 @@
 """
 
 import os
+import io
 import sys
-import subprocess
-
-try:
-    import io
-    io_method = io.BytesIO
-except:
-    import cStringIO
-    io_method = cStringIO.StringIO
+import zlib
+import mmap
+import struct
+import threading
+import queue
+import bisect
+from itertools import islice
+import numpy as np
+from . import compression
+from . import util
 
 
 class FastqRecord:
@@ -83,33 +86,369 @@ class FastqRecord:
         return self.__quality
 
 
+class FastqBatch:
+    """ Represents a batch of consecutive FASTQ records stored column-wise
+
+    The lines of all records are kept as lists of raw bytes. The values of each column
+    are decoded in one go on the first access, and can also be obtained as one contiguous
+    buffer with an array of offsets (the i-th value is buffer[offsets[i]:offsets[i + 1]]),
+    or as a uint8 matrix (one row per record) if all values have the same length.
+
+    Attributes:
+        ids: ids of the records (the first lines)
+        sequences: nucleotide sequences (the second lines)
+        descriptions: descriptions of the records (the third lines)
+        qualities: qualities of the sequences (the forth lines)
+    """
+
+    __slots__ = ('__lines', '__values')
+
+    __ID = 0
+    __SEQUENCE = 1
+    __DESCRIPTION = 2
+    __QUALITY = 3
+
+    def __init__(self, ids, sequences, descriptions, qualities):
+        """ Inits FastqBatch with lists of raw (bytes) lines"""
+        self.__lines = (ids, sequences, descriptions, qualities)
+        self.__values = [None] * 4
+
+    def validate(self):
+        """ Checks if the first and third lines of all records start with expected symbols
+        Raises:
+            ValueError: occurs when the format is wrong
+        """
+        ids, _, descriptions, _ = self.__lines
+        if (b'\n' + b'\n'.join(ids)).count(b'\n@') != len(ids):
+            raise ValueError(
+                'FASTQ format: the first line of a record should start with @ symbol.')
+        if (b'\n' + b'\n'.join(descriptions)).count(b'\n+') != len(descriptions):
+            raise ValueError(
+                'FASTQ format: the thrid line of a record should start with + symbol.')
+
+    def __len__(self):
+        return len(self.__lines[FastqBatch.__ID])
+
+    def __iter__(self):
+        """ Iterates over records of the batch. The same FastqRecord instance is reused"""
+        record = FastqRecord()
+        for values in zip(self.ids, self.sequences, self.descriptions, self.qualities):
+            record(*values)
+            yield record
+
+    @property
+    def size(self):
+        return len(self)
+
+    @property
+    def ids(self):
+        return self.__decoded(FastqBatch.__ID)
+
+    @property
+    def sequences(self):
+        return self.__decoded(FastqBatch.__SEQUENCE)
+
+    @property
+    def descriptions(self):
+        return self.__decoded(FastqBatch.__DESCRIPTION)
+
+    @property
+    def qualities(self):
+        return self.__decoded(FastqBatch.__QUALITY)
+
+    def decode(self):
+        """ Decodes values of all columns"""
+        for column in range(len(self.__lines)):
+            self.__decoded(column)
+
+    def __decoded(self, column):
+        values = self.__values[column]
+        if values is None:
+            lines = self.__lines[column]
+            values = b'\n'.join(lines).decode('utf-8').split('\n') if lines else []
+            self.__values[column] = values
+        return values
+
+    def id_buffer(self):
+        return self.__buffer(FastqBatch.__ID)
+
+    def sequence_buffer(self):
+        return self.__buffer(FastqBatch.__SEQUENCE)
+
+    def quality_buffer(self):
+        return self.__buffer(FastqBatch.__QUALITY)
+
+    def __buffer(self, column):
+        lines = self.__lines[column]
+        offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, lines), dtype=np.int64, count=len(lines)),
+                  out=offsets[1:])
+        return b''.join(lines), offsets
+
+    @property
+    def read_length(self):
+        """ The length of sequences if all sequences in the batch have the same length, None otherwise"""
+        lengths = set(map(len, self.__lines[FastqBatch.__SEQUENCE]))
+        return lengths.pop() if len(lengths) == 1 else None
+
+    def sequence_matrix(self):
+        return self.__matrix(FastqBatch.__SEQUENCE)
+
+    def quality_matrix(self):
+        return self.__matrix(FastqBatch.__QUALITY)
+
+    def __matrix(self, column):
+        read_length = self.read_length
+        if read_length is None:
+            raise ValueError('Reads in the batch have different lengths')
+        buffer = b''.join(self.__lines[column])
+        if len(buffer) != read_length * len(self):
+            raise ValueError('Sequence and quality lines have different lengths')
+        return np.frombuffer(buffer, dtype=np.uint8).reshape(len(self), read_length)
+
+
+class _FileRangeStream(io.RawIOBase):
+    """ Raw stream over the [start, stop) range of bytes of a file (stop=None - to the end)"""
+
+    def __init__(self, file_name, start, stop=None):
+        self.__file = open(file_name, 'rb')
+        self.__file.seek(start)
+        self.__remaining = None if stop is None else stop - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = len(buffer)
+        if self.__remaining is not None:
+            size = min(size, self.__remaining)
+        data = self.__file.read(size)
+        buffer[:len(data)] = data
+        if self.__remaining is not None:
+            self.__remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self.__file.close()
+        io.RawIOBase.close(self)
+
+
+class _GzipMembersStream(io.RawIOBase):
+    """ Raw stream of data decompressed from gzip members of a multi-member gzip file
+
+    Decompression starts from the member at the start offset. The data of members that
+    start at or after the end offset are limited by the extra number of bytes
+    (extra=None - no limit). The first skip bytes of the data are dropped.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, file_name, start, end=None, skip=0, extra=None):
+        self.__file = open(file_name, 'rb')
+        self.__file.seek(start)
+        self.__file_pos = start
+        self.__end = end
+        self.__skip = skip
+        self.__extra = extra
+        self.__after_end = False
+        self.__decompressor = zlib.decompressobj(31)
+        self.__data = b''
+        self.__eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.__data and not self.__eof:
+            self.__decompress_chunk()
+
+        size = min(len(buffer), len(self.__data))
+        buffer[:size] = self.__data[:size]
+        self.__data = self.__data[size:]
+        return size
+
+    def __decompress_chunk(self):
+        chunk = self.__file.read(_GzipMembersStream.CHUNK_SIZE)
+        self.__file_pos += len(chunk)
+        if not chunk:
+            self.__eof = True
+            return
+
+        while chunk:
+            self.__output(self.__decompressor.decompress(chunk))
+            if not self.__decompressor.eof:
+                break
+
+            # the member is done, the rest of the chunk belongs to the next members
+            chunk = self.__decompressor.unused_data
+            self.__decompressor = zlib.decompressobj(31)
+            if self.__end is not None and self.__file_pos - len(chunk) >= self.__end:
+                self.__after_end = True
+                if self.__extra == 0:
+                    self.__eof = True
+
+    def __output(self, data):
+        if self.__after_end and self.__extra is not None:
+            data = data[:self.__extra]
+            self.__extra -= len(data)
+            if self.__extra == 0:
+                self.__eof = True
+
+        if self.__skip:
+            skipped = min(self.__skip, len(data))
+            data = data[skipped:]
+            self.__skip -= skipped
+
+        self.__data += data
+
+    def close(self):
+        self.__file.close()
+        io.RawIOBase.close(self)
+
+
+class _MappedFileLines:
+    """ Reads lines from the [start, stop) range of bytes of a memory-mapped file
+
+    Line ends are searched directly in the mapped memory, and lines are returned as
+    bytes slices of the mapping. The pages of the file are shared via the OS page cache
+    by all processes reading the same file.
+    """
+
+    def __init__(self, file_name, start=0, stop=None):
+        self.__file = open(file_name, 'rb')
+        try:
+            self.__mmap = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.__file.close()
+            raise
+        if hasattr(self.__mmap, 'madvise'):
+            self.__mmap.madvise(mmap.MADV_SEQUENTIAL)
+
+        self.__mmap.seek(start)
+        self.__stop = len(self.__mmap) if stop is None else stop
+        # the expected size of a line, used to estimate the size of blocks
+        self.__line_size = 128
+
+    def readline(self):
+        # the stop is always at the start of a line
+        if self.__mmap.tell() >= self.__stop:
+            return b''
+        return self.__mmap.readline()
+
+    def read_lines(self, count):
+        """ Reads up to count lines. Returns a list of lines without line ends"""
+        lines = []
+        start = pos = self.__mmap.tell()
+        while len(lines) < count and pos < self.__stop:
+            end = min(pos + (count - len(lines)) * self.__line_size, self.__stop)
+            if end < self.__stop:
+                # cut the block at the end of the last complete line
+                end = self.__mmap.rfind(b'\n', pos, end) + 1
+                if end == 0:
+                    self.__line_size *= 2
+                    continue
+
+            block_lines = self.__mmap[pos:end].split(b'\n')
+            if not block_lines[-1]:
+                block_lines.pop()
+            if len(block_lines) > count - len(lines):
+                del block_lines[count - len(lines):]
+                end = pos + sum(map(len, block_lines)) + len(block_lines)
+            lines += block_lines
+            pos = end
+
+        self.__mmap.seek(pos)
+        if lines:
+            self.__line_size = (pos - start) // len(lines) + 1
+        return lines
+
+    def close(self):
+        self.__mmap.close()
+        self.__file.close()
+
+
 class FastqReader:
-    __FILE_TYPE_GZ = 'gz'
+    """ Reads FASTQ records from a plain text or compressed file
+
+    All files are read as a binary stream through a buffer of a fixed size, so the memory
+    footprint does not depend on the size of the file. Compressed files (see compression
+    module for the supported formats) are decompressed by an external program and read
+    incrementally from its pipe. Plain text files are memory-mapped (unless use_mmap
+    is False). The records can be also read from stdin (file name '-') or a named pipe.
+    """
+
     __FILE_TYPE_TXT = 'txt'
 
-    def __init__(self, file_name):
+    BUFFER_SIZE = 1024 * 1024
+    BATCH_SIZE = 10000
+
+    def __init__(self, file_name, buffer_size=BUFFER_SIZE, shard=None, use_mmap=True,
+                 threads=None):
         self.__file_name = file_name
         self.__file_type = None
         self.__file = None
+        self.__process = None
+        self.__stream = None
+
+        if util.is_stream(file_name):
+            # stdin or a named pipe: the format is detected by the first bytes of the stream
+            self.__stream = sys.stdin.buffer if file_name == util.STDIN \
+                else open(file_name, 'rb', buffer_size)
+            codec = compression.find_codec_by_header(
+                self.__stream.peek(compression.HEADER_SIZE))
+        else:
+            codec = compression.find_codec(file_name)
+        self.__file_type = codec.name if codec else FastqReader.__FILE_TYPE_TXT
+
+        if self.__stream:
+            if codec:
+                self.__file, self.__process = codec.open(self.__stream, buffer_size, threads)
+            else:
+                self.__file = self.__stream
+        elif shard and not shard.whole_file:
+            # read only the records of the given part of the file
+            if not codec and use_mmap:
+                self.__file = FastqReader.__map_file(file_name, *shard.record_range())
+            if not self.__file:
+                self.__file = io.BufferedReader(shard.open_stream(), buffer_size)
+        elif codec:
+            self.__file, self.__process = codec.open(file_name, buffer_size, threads)
+        else:
+            if use_mmap:
+                self.__file = FastqReader.__map_file(file_name)
+            if not self.__file:
+                self.__file = open(file_name, 'rb', buffer_size)
 
-        if file_name.endswith('.gz'):
-            self.__file_type = FastqReader.__FILE_TYPE_GZ
-            p = subprocess.Popen(['gunzip', '-c', file_name],
-                                 stdout=subprocess.PIPE)
-            self.__file = io_method(p.communicate()[0])
+        if isinstance(self.__file, _MappedFileLines):
+            self.__read_lines = self.__file.read_lines
         else:
-            self.__file_type = FastqReader.__FILE_TYPE_TXT
-            self.__file = open(file_name, 'r')
+            self.__read_lines = self.__read_buffered_lines
+
+    @staticmethod
+    def __map_file(file_name, start=0, stop=None):
+        if start is None:
+            # no records
+            return None
+        try:
+            return _MappedFileLines(file_name, start, stop)
+        except (ValueError, EnvironmentError):
+            # empty files and files that do not support mmap are read in a regular way
+            return None
 
     def __nextline(self):
         line = self.__file.readline()
         if not line:
+            self.__check_process()
             raise EOFError()
 
-        if self.__file_type == FastqReader.__FILE_TYPE_GZ:
-            line = line.decode("utf-8")
+        return line.decode("utf-8").strip()
 
-        return line.strip()
+    def __check_process(self):
+        # make sure that the whole file was decompressed without errors
+        if self.__process and self.__process.wait() != 0:
+            raise IOError('Failed to decompress %s: %s exited with code %s'
+                          % (self.__file_name, self.__process.args[0],
+                             self.__process.returncode))
 
     @property
     def file_type(self):
@@ -145,8 +484,368 @@ class FastqReader:
 
         return record
 
+    def next_batch(self, batch_size=BATCH_SIZE):
+        """ Reads up to batch_size records in one go
+        Args:
+            batch_size: the maximal number of records in the batch
+        Returns:
+            FastqBatch or None if there are no more records
+        Raises:
+            ValueError: occurs when the format is wrong
+        """
+        lines = self.__read_lines(4 * batch_size)
+        if len(lines) < 4 * batch_size:
+            self.__check_process()
+            if not lines:
+                return None
+
+        if lines[0][-1:] == b'\r':
+            lines = [line.strip() for line in lines]
+        if len(lines) % 4 != 0:
+            raise ValueError(
+                'FASTQ format: the last record of %s is incomplete' % self.__file_name)
+
+        batch = FastqBatch(lines[0::4], lines[1::4], lines[2::4], lines[3::4])
+        batch.validate()
+        return batch
+
+    def __read_buffered_lines(self, count):
+        chunk = b''.join(islice(self.__file, count))
+        lines = chunk.split(b'\n')
+        if not lines[-1]:
+            lines.pop()
+        return lines
+
     def close(self):
-        self.__file.close()
+        if self.__file is not sys.stdin.buffer:
+            self.__file.close()
+        if self.__process:
+            # the decompression can be still running if the file was not read to the end
+            if self.__process.poll() is None:
+                self.__process.terminate()
+            self.__process.wait()
+        if self.__stream and self.__stream is not sys.stdin.buffer \
+                and self.__stream is not self.__file:
+            self.__stream.close()
+
+
+class FastqShard:
+    """ Represents a part of a FASTQ file defined by a range of bytes
+
+    A shard owns all records that start within its range of bytes. Plain text files can
+    be split at any position, while gzipped files can be split only at boundaries of gzip
+    members (BGZF files or files made by concatenation of gzipped parts). The reader of
+    a shard skips the partial record at the beginning of the range and reads the last
+    record beyond the end of the range. A record boundary is recognized as a line starting
+    with @ symbol followed by a line starting with + symbol two lines later.
+
+    Attributes:
+        file_name: name of the FASTQ file
+        start: the first byte of the shard
+        end: the byte after the last byte of the shard
+    """
+
+    __slots__ = ('__file_name', '__start', '__end')
+
+    __BGZF_HEADER = struct.Struct('<4BI2BH')
+
+    def __init__(self, file_name, start, end):
+        self.__file_name = file_name
+        self.__start = start
+        self.__end = end
+
+    def __str__(self):
+        return '%s[%s:%s]' % (self.__file_name, self.__start, self.__end)
+
+    @property
+    def file_name(self):
+        return self.__file_name
+
+    @property
+    def start(self):
+        return self.__start
+
+    @property
+    def end(self):
+        return self.__end
+
+    @property
+    def gzipped(self):
+        return compression.find_codec(self.__file_name) in (compression.GZIP, compression.BGZF)
+
+    @property
+    def whole_file(self):
+        return self.__start == 0 and self.__end >= os.path.getsize(self.__file_name)
+
+    def record_range(self):
+        """ Finds the range of bytes with records of the shard
+        Returns:
+            (begin, stop) offsets of the first record of the shard and the first record
+            of the next shard, where stop=None means the end of the file, and
+            begin=None means that the shard has no records. The offsets of gzipped files
+            are counted in the decompressed data starting from the start and end
+            gzip members respectively.
+        """
+        file_size = os.path.getsize(self.__file_name)
+        if self.__start >= file_size:
+            return None, None
+        begin = self.__record_start(self.__start)
+        stop = self.__record_start(self.__end) if self.__end < file_size else None
+        return begin, stop
+
+    def open_stream(self):
+        """ Opens a raw binary stream with the (decompressed) records of the shard"""
+        begin, stop = self.record_range()
+        if begin is None:
+            return io.BytesIO()
+
+        if self.gzipped:
+            return _GzipMembersStream(self.__file_name, self.__start, self.__end,
+                                      skip=begin, extra=stop)
+        return _FileRangeStream(self.__file_name, begin, stop)
+
+    def __record_start(self, pos):
+        """ Finds the first record that starts at or after the pos. Returns the offset of the
+        record in the file (plain text files) or in the decompressed data of gzip members
+        starting from the pos (gzipped files). Returns None if there are no records.
+        """
+        if pos == 0:
+            return 0
+
+        if self.gzipped:
+            stream = _GzipMembersStream(self.__file_name, pos)
+            pos = 0
+        else:
+            # start from the previous byte to not skip a line starting at pos
+            pos -= 1
+            stream = _FileRangeStream(self.__file_name, pos)
+
+        with io.BufferedReader(stream) as f:
+            skip = FastqShard.__skip_to_record(f)
+        return None if skip is None else pos + skip
+
+    @staticmethod
+    def __skip_to_record(f):
+        # the first line can be partial
+        skip = len(f.readline())
+        lines = [f.readline() for _ in range(7)]
+        for i in range(4):
+            header, sequence, description, quality = lines[i:i + 4]
+            if header[:1] == b'@' and description[:1] == b'+' \
+                    and len(sequence.rstrip()) == len(quality.rstrip()):
+                return skip
+            skip += len(header)
+        return None
+
+    @staticmethod
+    def split(file_name, shards_count):
+        """ Splits FASTQ file into shards of (approximately) equal size
+        Args:
+            file_name: name of the FASTQ file (can be gzipped)
+            shards_count: the number of shards
+        Returns:
+            list of FastqShard. Gzipped files with one gzip member and files compressed
+            by other formats can not be split.
+        """
+        file_size = os.path.getsize(file_name)
+        targets = [file_size * i // shards_count for i in range(shards_count)]
+        codec = compression.find_codec(file_name)
+        if codec in (compression.GZIP, compression.BGZF):
+            offsets = FastqShard.gzip_member_offsets(file_name)
+            starts = []
+            for target in targets:
+                i = bisect.bisect_left(offsets, target)
+                if i < len(offsets):
+                    starts.append(offsets[i])
+        elif codec:
+            # other compression formats can not be split
+            starts = [0]
+        else:
+            starts = targets
+
+        starts = sorted(set(starts))
+        ends = starts[1:] + [file_size]
+        return [FastqShard(file_name, start, end) for start, end in zip(starts, ends)]
+
+    @staticmethod
+    def gzip_member_offsets(file_name):
+        """ Returns offsets of gzip members of a gzipped file.
+        The blocks of BGZF files are found from their headers, other files are decompressed
+        """
+        offsets = FastqShard.__bgzf_block_offsets(file_name)
+        if offsets is not None:
+            return offsets
+
+        offsets = [0]
+        file_pos = 0
+        decompressor = zlib.decompressobj(31)
+        with open(file_name, 'rb') as f:
+            while True:
+                chunk = f.read(_GzipMembersStream.CHUNK_SIZE)
+                if not chunk:
+                    break
+                file_pos += len(chunk)
+                while chunk:
+                    decompressor.decompress(chunk)
+                    if not decompressor.eof:
+                        break
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(31)
+                    if chunk:
+                        offsets.append(file_pos - len(chunk))
+        return offsets
+
+    @staticmethod
+    def __bgzf_block_offsets(file_name):
+        header = FastqShard.__BGZF_HEADER
+        offsets = []
+        file_size = os.path.getsize(file_name)
+        with open(file_name, 'rb') as f:
+            pos = 0
+            while pos < file_size:
+                f.seek(pos)
+                data = f.read(header.size)
+                if len(data) < header.size:
+                    return None
+                id1, id2, cm, flg, _, _, _, xlen = header.unpack(data)
+                if (id1, id2, cm) != (0x1f, 0x8b, 8) or not flg & 4:
+                    return None
+
+                # find BC subfield with the size of the block
+                extra = f.read(xlen)
+                block_size = None
+                i = 0
+                while i + 4 <= len(extra):
+                    slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+                    if extra[i:i + 2] == b'BC' and slen == 2:
+                        block_size = struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+                        break
+                    i += 4 + slen
+                if block_size is None:
+                    return None
+
+                offsets.append(pos)
+                pos += block_size
+        return offsets
+
+
+class PrefetchFastqReader:
+    """ Reads FASTQ records in a background thread
+
+    Batches of records are read (and decoded) by a background thread and passed to the
+    consumer through a bounded queue, so reading of the file overlaps with the processing
+    of the records. Provides the same interface as FastqReader.
+    """
+
+    QUEUE_SIZE = 4
+
+    def __init__(self, file_name, queue_size=QUEUE_SIZE,
+                 batch_size=FastqReader.BATCH_SIZE, **kwargs):
+        self.__reader = FastqReader(file_name, **kwargs)
+        self.__batch_size = batch_size
+        self.__queue = queue.Queue(maxsize=queue_size)
+        self.__stopped = threading.Event()
+        self.__exhausted = False
+        self.__records = iter(())
+
+        self.__thread = threading.Thread(target=self.__prefetch)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __prefetch(self):
+        try:
+            while not self.__stopped.is_set():
+                batch = self.__reader.next_batch(self.__batch_size)
+                if batch:
+                    # decode here rather than in the consumer thread
+                    batch.decode()
+                self.__put(batch)
+                if not batch:
+                    break
+        except Exception as e:
+            self.__put(e)
+
+    def __put(self, item):
+        while not self.__stopped.is_set():
+            try:
+                self.__queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+    @property
+    def file_type(self):
+        return self.__reader.file_type
+
+    @property
+    def file_name(self):
+        return self.__reader.file_name
+
+    def next_batch(self, batch_size=None):
+        """ Returns the next prefetched FastqBatch or None if there are no more records
+        Args:
+            batch_size: the batches are read ahead, so their size is defined when the reader
+                is created. Any other value is rejected
+        Raises:
+            ValueError: occurs when the batch size differs from the size of prefetched batches
+        """
+        if batch_size is not None and batch_size != self.__batch_size:
+            raise ValueError('Batches of %s records are prefetched, %s records are requested' % (
+                self.__batch_size, batch_size))
+        if self.__exhausted:
+            return None
+
+        item = self.__queue.get()
+        if isinstance(item, Exception):
+            self.__exhausted = True
+            raise item
+        if not item:
+            self.__exhausted = True
+        return item
+
+    def next_record(self, record):
+        source = self.__next_values()
+        if not source:
+            return False
+        record(*source)
+        return True
+
+    def next(self):
+        source = self.__next_values()
+        return FastqRecord(*source) if source else None
+
+    def __next_values(self):
+        for values in self.__records:
+            return values
+
+        batch = self.next_batch()
+        if not batch:
+            return None
+        self.__records = zip(batch.ids, batch.sequences,
+                             batch.descriptions, batch.qualities)
+        return self.__next_values()
+
+    def close(self):
+        self.__stopped.set()
+        self.__thread.join()
+        self.__reader.close()
+
+
+def open_fastq_reader(file_name, prefetch_batches=0, shard=None, threads=None):
+    """ Opens a reader of FASTQ records
+    Args:
+        file_name: name of the FASTQ file (can be compressed)
+        prefetch_batches: if > 0, the records are read in a background thread,
+            and up to prefetch_batches batches of records are kept in memory
+        shard: FastqShard to read only a part of the file
+        threads: the number of threads to decompress the file (if supported)
+    Returns:
+        FastqReader or PrefetchFastqReader
+    """
+    if prefetch_batches:
+        return PrefetchFastqReader(file_name, queue_size=prefetch_batches, shard=shard,
+                                   threads=threads)
+    return FastqReader(file_name, shard=shard, threads=threads)
 
 
 class FastqFileStat:
@@ -161,13 +860,33 @@ class FastqFileStat:
     def __init__(self):
         self.__total_reads_count = 0
         self.__barcode_extracted_reads_count = 0
+        self.__extraction_stats = []
 
     def total_reads_inc(self):
         self.__total_reads_count += 1
 
+    def add_extraction_stats(self, barcode_matcher, tag_name=None):
+        ''' Records the statistics of barcode extraction: the histogram of primer position
+            shifts and the statistics of the cache (if any) of the BarcodeMatcher. The cache
+            is not used (and not reported) if the batches were matched vectorized.
+        '''
+        prefix = tag_name + ' ' if tag_name else ''
+        self.__extraction_stats.append('%sprimer %s' % (
+            prefix, str(barcode_matcher.shift_histogram)))
+        if barcode_matcher.cache is not None and barcode_matcher.cache.lookups_count:
+            self.__extraction_stats.append('%sextraction cache: %s' % (
+                prefix, str(barcode_matcher.cache)))
+
+    @property
+    def extraction_stats(self):
+        return self.__extraction_stats
+
     def barcode_extracted_reads_inc(self):
         self.__barcode_extracted_reads_count += 1
 
+    def barcode_extracted_reads_add(self, count):
+        self.__barcode_extracted_reads_count += count
+
     def __str__(self):
         return "\t".join(str(x) for x in [
             self.__total_reads_count,
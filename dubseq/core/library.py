@@ -0,0 +1,229 @@
+""" Counting of reads of barcodes of a known library
+
+The barcodes of a library (e.g. the recommended up barcodes of a BPAG file) are kept as a
+sorted array of packed sequences (see util.pack_sequence), and reads are counted in dense
+arrays indexed by the position of a barcode in the library. A barcode that is not in the
+library is rescued if it differs by one nucleotide from exactly one library barcode. The
+memory depends on the size of the library rather than on the number of distinct barcodes
+(most of which are caused by sequencing errors).
+"""
+
+import numpy as np
+import pandas as pd
+from . import util
+from . import similarity
+
+
+class BarcodeLibrary:
+    ''' Barcodes of a library with their indices
+    '''
+
+    NOT_FOUND = -1
+    AMBIGUOUS = -2
+
+    def __init__(self, barcodes):
+        '''
+        Args:
+            barcodes: list of barcode sequences, the index of a barcode in the list is its
+                index in the library. Barcodes with symbols other than A, C, G, T are never
+                matched
+        '''
+        self.__barcodes = list(barcodes)
+
+        codes = [util.pack_sequence(barcode) for barcode in self.__barcodes]
+        packed_indices = [index for index, code in enumerate(codes)
+                          if similarity.is_packed(code)]
+        keys = np.array([codes[index] for index in packed_indices], dtype=np.uint64)
+
+        # the last barcode wins if a library has duplicates (as in Fitness.updateBARCODE_INDICES),
+        # so the unique keys are taken from the reversed list
+        self.__keys, last_indices = np.unique(keys[::-1], return_index=True)
+        self.__key_indices = np.array(packed_indices, dtype=np.int64)[::-1][last_indices]
+        self.__length_ranges = similarity.length_ranges(self.__keys)
+
+    @staticmethod
+    def load_bpag(file_name):
+        ''' Loads the up barcodes of the recommended barcode pairs of a BPAG file
+            (in the order of the file, as Fitness.loadBPAG does)
+        '''
+        df = pd.read_csv(file_name, sep='\t', usecols=['barcode_up', 'recommended'])
+        return BarcodeLibrary(df[df.recommended == '+'].barcode_up.tolist())
+
+    @property
+    def size(self):
+        return len(self.__barcodes)
+
+    @property
+    def barcodes(self):
+        return self.__barcodes
+
+    def find(self, keys):
+        ''' Finds library barcodes
+        Args:
+            keys: uint64 array of packed sequences
+        Returns:
+            int64 array with the library index of each barcode or NOT_FOUND
+        '''
+        if not len(self.__keys):
+            return np.full(len(keys), BarcodeLibrary.NOT_FOUND, dtype=np.int64)
+
+        positions = np.searchsorted(self.__keys, keys)
+        positions[positions == len(self.__keys)] = 0
+        return np.where(self.__keys[positions] == keys, self.__key_indices[positions],
+                        BarcodeLibrary.NOT_FOUND)
+
+    def rescue(self, keys):
+        ''' Finds library barcodes that differ from barcodes by one nucleotide
+        Args:
+            keys: uint64 array of packed sequences that are not in the library
+        Returns:
+            int64 array with the library index of each barcode, NOT_FOUND, or AMBIGUOUS
+            if there are several similar library barcodes
+        '''
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        indices = np.full(len(unique_keys), BarcodeLibrary.NOT_FOUND, dtype=np.int64)
+        matches_counts = np.zeros(len(unique_keys), dtype=np.int64)
+
+        library_lengths = set(length for _, _, length in self.__length_ranges)
+        for start, end, length in similarity.length_ranges(unique_keys):
+            if length not in library_lengths:
+                continue
+
+            range_keys = unique_keys[start:end]
+            for pos in range(length):
+                shift = np.uint64(2 * (length - 1 - pos))
+                nucleotides = (range_keys >> shift) & np.uint64(3)
+                cleared_keys = range_keys & ~(np.uint64(3) << shift)
+                for nucleotide in range(4):
+                    found = self.find(cleared_keys | (np.uint64(nucleotide) << shift))
+                    found[nucleotides == nucleotide] = BarcodeLibrary.NOT_FOUND
+                    is_found = found != BarcodeLibrary.NOT_FOUND
+                    indices[start:end][is_found] = found[is_found]
+                    matches_counts[start:end] += is_found
+
+        indices[matches_counts > 1] = BarcodeLibrary.AMBIGUOUS
+        return indices[inverse]
+
+    def rescue_code(self, code):
+        ''' Finds a library barcode that differs by one nucleotide from a packed sequence
+            that does not fit into uint64 (e.g. a barcode with N)
+        Returns:
+            the library index, NOT_FOUND, or AMBIGUOUS (see rescue)
+        '''
+        keys = np.array([similar_code for similar_code in util.similar_codes(code)
+                         if similarity.is_packed(similar_code)], dtype=np.uint64)
+        indices = np.unique(self.find(keys))
+        indices = indices[indices != BarcodeLibrary.NOT_FOUND]
+        if not len(indices):
+            return BarcodeLibrary.NOT_FOUND
+        return int(indices[0]) if len(indices) == 1 else BarcodeLibrary.AMBIGUOUS
+
+
+class LibraryCounter:
+    ''' Counts reads of library barcodes
+
+    The codes are counted in batches (add) or one by one (inc) as with BarcodeCounter,
+    they are buffered and looked up in the library in batches.
+    '''
+
+    BUFFER_SIZE = 1 << 16
+
+    def __init__(self, library, rescue=True):
+        self.__library = library
+        self.__rescue = rescue
+        self.__exact_reads_counts = np.zeros(library.size, dtype=np.int64)
+        self.__rescued_reads_counts = np.zeros(library.size, dtype=np.int64)
+        self.__ambiguous_reads_count = 0
+        self.__unknown_reads_count = 0
+        # codes added by inc, but not yet counted
+        self.__buffer = []
+
+    def inc(self, code):
+        ''' Counts one read of a barcode (the code is buffered)'''
+        self.__buffer.append(code)
+        if len(self.__buffer) >= LibraryCounter.BUFFER_SIZE:
+            self.flush()
+
+    def add(self, codes):
+        ''' Counts a batch of barcodes (the codes are buffered)'''
+        self.__buffer.extend(codes)
+        if len(self.__buffer) >= LibraryCounter.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        ''' Counts the buffered codes'''
+        if not self.__buffer:
+            return
+        buffer = self.__buffer
+        self.__buffer = []
+
+        # the codes that do not fit into uint64 (e.g. with Ns) are rescued one by one
+        try:
+            keys = np.array(buffer, dtype=np.uint64)
+            other_codes = []
+        except (OverflowError, TypeError, ValueError):
+            keys = np.array([code for code in buffer if similarity.is_packed(code)],
+                            dtype=np.uint64)
+            other_codes = [code for code in buffer if not similarity.is_packed(code)]
+
+        indices = self.__library.find(keys)
+        is_found = indices != BarcodeLibrary.NOT_FOUND
+        self.__exact_reads_counts += np.bincount(
+            indices[is_found], minlength=self.__library.size)
+
+        keys = keys[~is_found]
+        if not self.__rescue:
+            self.__unknown_reads_count += len(keys) + len(other_codes)
+            return
+
+        indices = np.concatenate([
+            self.__library.rescue(keys),
+            np.array([self.__library.rescue_code(code) for code in other_codes],
+                     dtype=np.int64)])
+        is_rescued = indices >= 0
+        self.__rescued_reads_counts += np.bincount(
+            indices[is_rescued], minlength=self.__library.size)
+        self.__ambiguous_reads_count += int(np.sum(indices == BarcodeLibrary.AMBIGUOUS))
+        self.__unknown_reads_count += int(np.sum(indices == BarcodeLibrary.NOT_FOUND))
+
+    @property
+    def reads_counts(self):
+        ''' Returns an array with reads counts (exact and rescued) of library barcodes'''
+        self.flush()
+        return self.__exact_reads_counts + self.__rescued_reads_counts
+
+    @property
+    def exact_reads_counts(self):
+        self.flush()
+        return self.__exact_reads_counts
+
+    @property
+    def rescued_reads_counts(self):
+        self.flush()
+        return self.__rescued_reads_counts
+
+    @property
+    def ambiguous_reads_count(self):
+        self.flush()
+        return self.__ambiguous_reads_count
+
+    @property
+    def unknown_reads_count(self):
+        self.flush()
+        return self.__unknown_reads_count
+
+    def __str__(self):
+        return 'exact: %s, rescued: %s, ambiguous: %s, not in library: %s' % (
+            int(self.exact_reads_counts.sum()), int(self.rescued_reads_counts.sum()),
+            self.ambiguous_reads_count, self.unknown_reads_count)
+
+    def save(self, file_name):
+        ''' Saves reads counts of all library barcodes in the order of the library'''
+        with open(file_name, 'w') as f:
+            f.write('\t'.join(['barcode', 'reads_count', 'exact_reads_count',
+                               'rescued_reads_count']) + '\n')
+            for barcode, reads_count, exact_reads_count, rescued_reads_count in zip(
+                    self.__library.barcodes, self.reads_counts.tolist(),
+                    self.exact_reads_counts.tolist(), self.rescued_reads_counts.tolist()):
+                f.write("%s\t%s\t%s\t%s\n" % (
+                    barcode, reads_count, exact_reads_count, rescued_reads_count))
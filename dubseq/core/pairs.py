@@ -0,0 +1,183 @@
+""" Adjacency of up and down barcodes of barcode pairs
+
+The barcode pairs are compiled into two adjacency structures in compressed sparse row (CSR)
+format: for each up barcode, the down barcodes paired with it with the reads counts of the
+pairs, and the same for each down barcode. The rows are the segments of flat arrays bounded
+by offsets, so the statistics of the pairs of all barcodes (e.g. the maximal reads count of
+a pair) are computed by reductions over the segments rather than by loops over the pairs.
+"""
+
+import itertools
+import numpy as np
+
+
+class PairAdjacency:
+    ''' Pairs grouped by the barcode of one side in CSR format: the pairs of the i-th barcode
+        are in the range [offsets[i], offsets[i + 1]) of the arrays of paired barcodes
+        and reads counts, in the order of the pairs
+    '''
+
+    def __init__(self, indices, paired_indices, reads_counts, size):
+        '''
+        Args:
+            indices: int64 array with the index of the barcode of each pair
+            paired_indices: int64 array with the index of the paired barcode of each pair
+            reads_counts: int64 array with the reads count of each pair
+            size: the number of barcodes
+        '''
+        # the stable sort keeps the order of pairs within the rows
+        order = np.argsort(indices, kind='stable')
+        self.__offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(indices, minlength=size), out=self.__offsets[1:])
+        self.__paired_indices = paired_indices[order]
+        self.__reads_counts = reads_counts[order]
+
+    @property
+    def size(self):
+        return len(self.__offsets) - 1
+
+    @property
+    def offsets(self):
+        return self.__offsets
+
+    @property
+    def paired_indices(self):
+        return self.__paired_indices
+
+    @property
+    def reads_counts(self):
+        return self.__reads_counts
+
+    def row(self, index):
+        ''' Returns (paired_indices, reads_counts) of the pairs of a barcode'''
+        start, end = self.__offsets[index], self.__offsets[index + 1]
+        return self.__paired_indices[start:end], self.__reads_counts[start:end]
+
+    def rows_reads_counts(self):
+        ''' Returns a list with the list of reads counts of the pairs of each barcode'''
+        reads_counts = self.__reads_counts.tolist()
+        offsets = self.__offsets.tolist()
+        return [reads_counts[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def reads_counts_sum(self):
+        ''' Returns an array with the total reads count of the pairs of each barcode
+            (0 if a barcode has no pairs)
+        '''
+        return self.__segment_reduce(np.add, self.__reads_counts)
+
+    def reads_counts_max(self):
+        ''' Returns an array with the maximal reads count of the pairs of each barcode
+            (0 if a barcode has no pairs)
+        '''
+        return self.__segment_reduce(np.maximum, self.__reads_counts)
+
+    def reads_counts_submax(self):
+        ''' Returns an array with the second maximal reads count of the pairs of each barcode,
+            which equals the maximal one if it is shared by several pairs (0 if a barcode
+            has less than two pairs)
+        '''
+        counts_max = self.__segment_reduce(np.maximum, self.__reads_counts)
+        if not len(self.__reads_counts):
+            return counts_max
+
+        # exclude the first pair with the maximal reads count of each row
+        rows = np.repeat(np.arange(self.size), np.diff(self.__offsets))
+        is_max = self.__reads_counts == counts_max[rows]
+        max_positions = np.flatnonzero(is_max)
+        first_max_positions = max_positions[np.unique(rows[max_positions], return_index=True)[1]]
+
+        reads_counts = self.__reads_counts.copy()
+        reads_counts[first_max_positions] = 0
+        return self.__segment_reduce(np.maximum, reads_counts)
+
+    def __segment_reduce(self, ufunc, values):
+        result = np.zeros(self.size, dtype=np.int64)
+        is_empty = self.__offsets[:-1] == self.__offsets[1:]
+        if len(values):
+            starts = self.__offsets[:-1][~is_empty]
+            result[~is_empty] = ufunc.reduceat(values, starts)
+        return result
+
+
+class BarcodePairs:
+    ''' Reads counts of barcode pairs with the adjacency of up and down barcodes
+    '''
+
+    def __init__(self, barcodes12, up_codes, dn_codes):
+        '''
+        Args:
+            barcodes12: {(up code, dn code) => reads count of the pair}
+            up_codes: list of codes of up barcodes, which defines the indices of the barcodes
+            dn_codes: list of codes of down barcodes
+        '''
+        pairs_count = len(barcodes12)
+        self.__up_indices, self.__dn_indices = BarcodePairs.__pair_indices(
+            barcodes12, up_codes, dn_codes)
+        self.__reads_counts = np.fromiter(barcodes12.values(), dtype=np.int64,
+                                          count=pairs_count)
+
+        self.__up_adjacency = PairAdjacency(self.__up_indices, self.__dn_indices,
+                                            self.__reads_counts, len(up_codes))
+        self.__dn_adjacency = PairAdjacency(self.__dn_indices, self.__up_indices,
+                                            self.__reads_counts, len(dn_codes))
+
+    def __len__(self):
+        return len(self.__reads_counts)
+
+    @staticmethod
+    def __pair_indices(barcodes12, up_codes, dn_codes):
+        # the indices of the up and down barcodes of each pair
+        pairs_count = len(barcodes12)
+        has_sequences = any(isinstance(code, str) for codes in (up_codes, dn_codes)
+                            for code in codes)
+        if not has_sequences:
+            # the packed sequences (including the ones with Ns) are looked up in sorted arrays
+            try:
+                pair_codes = np.fromiter(itertools.chain.from_iterable(barcodes12),
+                                         dtype=np.int64, count=2 * pairs_count)
+                pair_codes = pair_codes.reshape(pairs_count, 2)
+                return (BarcodePairs.__find(np.array(up_codes, dtype=np.int64), pair_codes[:, 0]),
+                        BarcodePairs.__find(np.array(dn_codes, dtype=np.int64), pair_codes[:, 1]))
+            except OverflowError:
+                pass
+
+        up_indices = dict(zip(up_codes, range(len(up_codes))))
+        dn_indices = dict(zip(dn_codes, range(len(dn_codes))))
+        return (np.fromiter((up_indices[up_code] for up_code, _ in barcodes12),
+                            dtype=np.int64, count=pairs_count),
+                np.fromiter((dn_indices[dn_code] for _, dn_code in barcodes12),
+                            dtype=np.int64, count=pairs_count))
+
+    @staticmethod
+    def __find(codes, pair_codes):
+        # the search for sorted codes is faster due to the memory access pattern
+        order = np.argsort(codes)
+        pair_order = np.argsort(pair_codes)
+        indices = np.empty(len(pair_codes), dtype=np.int64)
+        indices[pair_order] = order[np.searchsorted(codes[order], pair_codes[pair_order])]
+        return indices
+
+    @property
+    def up_indices(self):
+        ''' int64 array with the index of the up barcode of each pair'''
+        return self.__up_indices
+
+    @property
+    def dn_indices(self):
+        ''' int64 array with the index of the down barcode of each pair'''
+        return self.__dn_indices
+
+    @property
+    def reads_counts(self):
+        ''' int64 array with the reads count of each pair'''
+        return self.__reads_counts
+
+    @property
+    def up_adjacency(self):
+        ''' PairAdjacency of up barcodes to down barcodes'''
+        return self.__up_adjacency
+
+    @property
+    def dn_adjacency(self):
+        ''' PairAdjacency of down barcodes to up barcodes'''
+        return self.__dn_adjacency
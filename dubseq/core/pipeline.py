@@ -0,0 +1,160 @@
+""" Staged processing of fastq records
+
+A pipeline runs the stages of processing (reading of records, extraction of barcodes,
+writing of the results) in separate threads connected by bounded queues. The stages overlap
+with each other, so the processing time is defined by the slowest stage rather than by the
+sum of all stages.
+"""
+
+import queue
+import threading
+
+# marks the end of the items passed between stages
+_END = object()
+
+
+class Pipeline:
+    """ Chain of processing stages connected by bounded queues
+
+    The items produced by a source are passed through the stages in order. Each stage is a
+    function taking an item and returning the item for the next stage (None items are
+    dropped). The source and all stages but the last one run in background threads, the
+    last stage runs in the calling thread. An exception raised by any stage stops the
+    pipeline and is re-raised by run().
+    """
+
+    QUEUE_SIZE = 4
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.__queue_size = queue_size
+        self.__stages = []
+        self.__stopped = threading.Event()
+
+    def add_stage(self, processor):
+        self.__stages.append(processor)
+        return self
+
+    def run(self, source):
+        """ Passes all items of the source through the stages
+        Args:
+            source: iterable of items, it is iterated in a background thread
+        """
+        if not self.__stages:
+            raise ValueError('The pipeline has no stages')
+
+        self.__stopped.clear()
+        input_queue = queue.Queue(maxsize=self.__queue_size)
+        threads = [threading.Thread(target=self.__produce, args=(source, input_queue))]
+        for processor in self.__stages[:-1]:
+            output_queue = queue.Queue(maxsize=self.__queue_size)
+            threads.append(threading.Thread(target=self.__process,
+                                            args=(processor, input_queue, output_queue)))
+            input_queue = output_queue
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            processor = self.__stages[-1]
+            for item in self.__items(input_queue):
+                processor(item)
+        finally:
+            self.__stopped.set()
+            for thread in threads:
+                thread.join()
+
+    def __produce(self, source, output_queue):
+        try:
+            for item in source:
+                if self.__stopped.is_set():
+                    return
+                self.__put(output_queue, item)
+            self.__put(output_queue, _END)
+        except Exception as e:
+            self.__put(output_queue, e)
+
+    def __process(self, processor, input_queue, output_queue):
+        try:
+            for item in self.__items(input_queue):
+                result = processor(item)
+                if result is not None:
+                    self.__put(output_queue, result)
+            self.__put(output_queue, _END)
+        except Exception as e:
+            self.__put(output_queue, e)
+
+    def __items(self, input_queue):
+        while True:
+            try:
+                item = input_queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.__stopped.is_set():
+                    return
+                continue
+
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def __put(self, output_queue, item):
+        while not self.__stopped.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+
+def process_fastq_records(reader, processor, output_fps, extractors=(),
+                          queue_size=Pipeline.QUEUE_SIZE):
+    """ Processes all records of a fastq reader in three stages running in parallel:
+        1. reading (and decoding) of batches of records
+        2. processing of each record by processor(record, *values), which also aggregates
+           the results of the records
+        3. writing of the lines returned by the processor to the output files
+
+    Args:
+        reader: FastqReader or PrefetchFastqReader
+        processor: function taking FastqRecord (and a value of each extractor) and returning
+            None or a sequence with a line (or None) for each output file. The record object
+            is reused, so the processor should not keep a reference to it
+        output_fps: list of the output files
+        extractors: functions taking FastqBatch and returning a list of values (e.g. barcodes)
+            for all records of the batch at once. The values of a record are passed to the
+            processor
+        queue_size: the maximum number of batches waiting between the stages
+    """
+    pipeline = Pipeline(queue_size)
+    pipeline.add_stage(lambda batch: _process_batch(batch, processor, len(output_fps),
+                                                    extractors))
+    pipeline.add_stage(lambda texts: _write_texts(output_fps, texts))
+    pipeline.run(_read_batches(reader))
+
+
+def _read_batches(reader):
+    batch = reader.next_batch()
+    while batch:
+        # decode here rather than in the processing thread
+        batch.decode()
+        yield batch
+        batch = reader.next_batch()
+
+
+def _process_batch(batch, processor, outputs_count, extractors):
+    chunks = [[] for _ in range(outputs_count)]
+    for record_values in zip(batch, *[extractor(batch) for extractor in extractors]):
+        lines = processor(*record_values)
+        if lines:
+            for chunk, line in zip(chunks, lines):
+                if line:
+                    chunk.append(line)
+    return [''.join(chunk) for chunk in chunks]
+
+
+def _write_texts(output_fps, texts):
+    for output_fp, text in zip(output_fps, texts):
+        if text:
+            output_fp.write(text)
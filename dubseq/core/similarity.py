@@ -0,0 +1,552 @@
+""" Search for similar barcodes in arrays of packed sequences
+
+Barcodes are packed into ints by util.pack_sequence: 2 bits per nucleotide prefixed by 1.
+Barcodes within a Hamming distance d are found with HammingIndex without enumerating
+the neighbours of each barcode: a barcode is split into segments, and two barcodes within
+the distance d share at least (segments count - d) segments (pigeonhole principle), so
+only the barcodes sharing the segments are compared, with bit operations on whole arrays.
+"""
+
+import bisect
+import itertools
+import multiprocessing
+import numpy as np
+from . import util
+
+# the longest sequence packed into uint64 (2 bits per nucleotide and the leading 1)
+MAX_PACKED_LENGTH = 31
+__MAX_KEY = (1 << 64) - 1
+__HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+# the numbers of set bits of bytes (np.bitwise_count is available since numpy 2.0)
+__BYTE_BIT_COUNTS = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+
+def is_packed(code):
+    ''' Checks if a packed sequence fits into uint64
+    '''
+    return isinstance(code, (int, np.integer)) and 0 < code <= __MAX_KEY
+
+
+def similar_code_pairs(codes, max_distance=1, workers=1, indels=False):
+    ''' Finds pairs of barcodes that differ by one nucleotide (or by up to max_distance
+        substitutions)
+
+    Args:
+        codes: list of distinct packed sequences (see util.pack_sequence)
+        max_distance: the maximum Hamming distance between similar barcodes. Barcodes
+            that are not packed into uint64 (with Ns or other symbols) are compared
+            at the distance 1 only
+        workers: the number of processes to search for similar barcodes
+        indels: if True, barcodes that differ by one indel (see DeletionIndex) are
+            similar as well. Barcodes that are not packed into uint64 are not compared
+            for indels
+
+    Returns:
+        (indices, similar_indices): int64 arrays with indices of codes, a barcode
+        codes[indices[i]] is similar to the barcode codes[similar_indices[i]]. The pairs are
+        ordered by the first index, and the similar barcodes of each barcode are ordered as
+        util.similar_codes generates them (see hamming_key_pairs), followed by the barcodes
+        that differ by an indel (see deletion_key_pairs)
+    '''
+    packed = np.fromiter((is_packed(code) for code in codes), dtype=bool, count=len(codes))
+    packed_indices = np.flatnonzero(packed)
+    keys = np.array([codes[i] for i in packed_indices.tolist()], dtype=np.uint64)
+
+    # sort the keys to index them and to look them up with bisect
+    key_order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[key_order]
+    key_indices = packed_indices[key_order]
+
+    sorted_indices, sorted_similar_indices = hamming_key_pairs(sorted_keys, max_distance, workers)
+    if indels:
+        # add the pairs that are not within the Hamming distance
+        indel_indices, indel_similar_indices = deletion_key_pairs(sorted_keys, workers)
+        is_new = ~np.isin(indel_indices * len(sorted_keys) + indel_similar_indices,
+                          sorted_indices * len(sorted_keys) + sorted_similar_indices)
+        indices = np.concatenate([sorted_indices, indel_indices[is_new]])
+        order = np.argsort(indices, kind='stable')
+        sorted_indices = indices[order]
+        sorted_similar_indices = np.concatenate(
+            [sorted_similar_indices, indel_similar_indices[is_new]])[order]
+
+    indices = [key_indices[sorted_indices]]
+    similar_indices = [key_indices[sorted_similar_indices]]
+
+    # the rest of barcodes (with Ns or other symbols) are processed one by one
+    other_indices = np.flatnonzero(~packed).tolist()
+    if other_indices:
+        other_code_indices = dict((codes[i], i) for i in other_indices)
+        _indices = []
+        _similar_indices = []
+        for index in other_indices:
+            for similar_code in util.similar_codes(codes[index]):
+                similar_index = None
+                if is_packed(similar_code):
+                    pos = bisect.bisect_left(sorted_keys, similar_code)
+                    if pos < len(sorted_keys) and sorted_keys[pos] == similar_code:
+                        similar_index = int(key_indices[pos])
+                else:
+                    similar_index = other_code_indices.get(similar_code)
+                if similar_index is not None:
+                    _indices.append(index)
+                    _similar_indices.append(similar_index)
+        indices.append(np.array(_indices, dtype=np.int64))
+        similar_indices.append(np.array(_similar_indices, dtype=np.int64))
+
+    indices = np.concatenate(indices)
+    similar_indices = np.concatenate(similar_indices)
+    order = np.argsort(indices, kind='stable')
+    return indices[order], similar_indices[order]
+
+
+def hamming_key_pairs(sorted_keys, max_distance=1, workers=1, segments_count=None):
+    ''' Finds pairs of packed barcodes within a Hamming distance
+
+    Args:
+        sorted_keys: uint64 array of distinct packed sequences sorted in ascending order
+        max_distance: the maximum Hamming distance between similar barcodes
+        workers: the number of processes, each of them searches in its part of the
+            index (see HammingIndex.pairs)
+        segments_count: see HammingIndex
+
+    Returns:
+        (indices, similar_indices): int64 arrays with indices of sorted_keys, ordered by the
+        first index, then by the position of the first mismatch, and then by the similar
+        barcode. For max_distance = 1 it is the order of util.similar_codes
+    '''
+    index = HammingIndex(sorted_keys, max_distance, segments_count)
+    indices, similar_indices = _index_pairs(index, workers)
+    order = index.pairs_order(indices, similar_indices)
+    return indices[order], similar_indices[order]
+
+
+def deletion_key_pairs(sorted_keys, workers=1, max_entries=None):
+    ''' Finds pairs of packed barcodes that differ by one substitution or one indel
+
+    Args:
+        sorted_keys: uint64 array of distinct packed sequences sorted in ascending order
+        workers: the number of processes, each of them searches in its part of the
+            index (see DeletionIndex.pairs)
+        max_entries: see DeletionIndex
+
+    Returns:
+        (indices, similar_indices): int64 arrays with indices of sorted_keys, ordered by
+        the first index and then by the similar barcode
+    '''
+    index = DeletionIndex(sorted_keys, max_entries)
+    indices, similar_indices = _index_pairs(index, workers)
+    pairs = np.unique(indices * len(sorted_keys) + similar_indices)
+    return pairs // len(sorted_keys), pairs % len(sorted_keys)
+
+
+def _index_pairs(index, workers):
+    ''' Collects pairs from all parts of an index (HammingIndex or DeletionIndex)
+    '''
+    if workers > 1 and not multiprocessing.current_process().daemon:
+        context = multiprocessing.get_context('fork')
+        with context.Pool(workers, _init_worker, (index, workers)) as pool:
+            parts = pool.map(_index_part_pairs, range(workers))
+    else:
+        parts = [index.pairs()]
+
+    indices = np.concatenate([part[0] for part in parts])
+    similar_indices = np.concatenate([part[1] for part in parts])
+    return indices, similar_indices
+
+
+def _init_worker(index, parts):
+    global _worker_index
+    _worker_index = (index, parts)
+
+
+def _index_part_pairs(part):
+    index, parts = _worker_index
+    return index.pairs(part, parts)
+
+
+def abundance_clusters(indices, similar_indices, reads_counts, ratio_threshold):
+    ''' Clusters barcodes in the order of decreasing abundance. A barcode that was not
+        absorbed by a more abundant barcode becomes a parent of a cluster, and absorbs
+        its similar barcodes (that are not absorbed yet) if the ratio of reads counts of
+        the parent and the similar barcode is at least ratio_threshold.
+
+    Args:
+        indices, similar_indices: int64 arrays with indices of pairs of similar barcodes
+            (both (i, j) and (j, i)), e.g. returned by similar_code_pairs
+        reads_counts: array with reads counts of barcodes
+        ratio_threshold: the minimum ratio of reads counts of a parent and an absorbed barcode
+
+    Returns:
+        int64 array with the index of the parent of each barcode (parents are their own
+        parents). Barcodes with the same reads count are ordered by their indices
+    '''
+    reads_counts = np.asarray(reads_counts, dtype=np.int64)
+    ranks = np.empty(len(reads_counts), dtype=np.int64)
+    ranks[np.lexsort((np.arange(len(reads_counts)), -reads_counts))] = \
+        np.arange(len(reads_counts))
+
+    # edges from a more abundant barcode to a barcode it can absorb
+    is_edge = (ranks[indices] < ranks[similar_indices]) & \
+        (reads_counts[indices] >= reads_counts[similar_indices] * ratio_threshold)
+    parent_candidates = indices[is_edge]
+    children = similar_indices[is_edge]
+
+    # a barcode is absorbed by the most abundant parent among its candidates, the parents
+    # of more abundant barcodes are known by the time a barcode is processed
+    order = np.lexsort((ranks[parent_candidates], ranks[children]))
+    parents = np.arange(len(reads_counts)).tolist()
+    is_absorbed = [False] * len(reads_counts)
+    for parent, child in zip(parent_candidates[order].tolist(), children[order].tolist()):
+        if not is_absorbed[child] and not is_absorbed[parent]:
+            parents[child] = parent
+            is_absorbed[child] = True
+    return np.array(parents, dtype=np.int64)
+
+
+class HammingIndex:
+    ''' Index of packed barcodes to find barcodes within a Hamming distance
+
+    Barcodes are split into segments of (almost) equal length. Two barcodes of the same
+    length within the distance d share at least k = (segments count - d) segments. For
+    each combination of k segments the barcodes are bucketed by the nucleotides of these
+    segments, and only the barcodes in the same bucket are compared. A pair is reported
+    only for the first combination of its shared segments, so each pair is reported once.
+
+    The buckets larger than MAX_BUCKET_SIZE (e.g. of low complexity barcodes like poly-A)
+    are searched with an index of the other segments of their barcodes, rather than by
+    comparison of all pairs.
+
+    The buckets can be split into parts (by a hash of the bucket) to search for pairs in
+    several processes.
+    '''
+
+    __ODD_BITS = np.uint64(0x5555555555555555)
+    MAX_BUCKET_SIZE = 1 << 10
+
+    def __init__(self, sorted_keys, max_distance=1, segments_count=None):
+        '''
+        Args:
+            sorted_keys: uint64 array of distinct packed sequences sorted in ascending order
+            max_distance: the maximum Hamming distance between similar barcodes
+            segments_count: the number of segments. More segments make smaller buckets,
+                but more combinations of segments. By default it is max_distance + 1 for
+                the distance 1, and 2 * max_distance for larger distances, so that the
+                buckets are defined by a half of a barcode
+        '''
+        if segments_count is None:
+            segments_count = max_distance + 1 if max_distance <= 1 else 2 * max_distance
+        if segments_count <= max_distance:
+            raise ValueError('The number of segments (%s) should be greater than the distance (%s)'
+                             % (segments_count, max_distance))
+
+        self.__keys = sorted_keys
+        self.__max_distance = max_distance
+        self.__segments_count = segments_count
+
+        self.__length_ranges = length_ranges(sorted_keys)
+
+    @property
+    def max_distance(self):
+        return self.__max_distance
+
+    def pairs(self, part=0, parts=1):
+        ''' Finds pairs of barcodes within the distance in a part of buckets
+
+        Args:
+            part: the index of the part of buckets
+            parts: the number of parts
+
+        Returns:
+            (indices, similar_indices): int64 arrays with indices of sorted keys, both
+            (i, j) and (j, i) are reported, the pairs are not ordered (see pairs_order)
+        '''
+        indices = [np.zeros(0, dtype=np.int64)]
+        similar_indices = [np.zeros(0, dtype=np.int64)]
+        for start, end, length in self.__length_ranges:
+            keys = self.__keys[start:end]
+            for index1, index2 in self.__length_pairs(keys, length, part, parts):
+                indices.extend([index1 + start, index2 + start])
+                similar_indices.extend([index2 + start, index1 + start])
+        return np.concatenate(indices), np.concatenate(similar_indices)
+
+    def pairs_order(self, indices, similar_indices):
+        ''' Returns an order of pairs by the first index, then by the position of the
+            first mismatch, and then by the similar barcode
+        '''
+        keys = self.__keys[indices]
+        similar_keys = self.__keys[similar_indices]
+        # the bit length of the mismatches, the first mismatch has the highest bit
+        mismatches = HammingIndex.__mismatches(keys, similar_keys)
+        for shift in [1, 2, 4, 8, 16, 32]:
+            mismatches |= mismatches >> np.uint64(shift)
+        first_mismatch_bits = _bit_counts(mismatches)
+        return np.lexsort((similar_keys, -first_mismatch_bits.astype(np.int64), indices))
+
+    @staticmethod
+    def __mismatches(keys1, keys2):
+        # a bit per nucleotide: the lower bit of each mismatched pair of bits
+        diff = keys1 ^ keys2
+        return (diff | (diff >> np.uint64(1))) & HammingIndex.__ODD_BITS
+
+    def __segment_bounds(self, length):
+        return [length * i // self.__segments_count for i in range(self.__segments_count + 1)]
+
+    def __segment_masks(self, length):
+        bounds = self.__segment_bounds(length)
+        masks = []
+        for segment_start, segment_end in zip(bounds[:-1], bounds[1:]):
+            # nucleotides are packed from the highest bits
+            bits = 2 * (segment_end - segment_start)
+            shift = 2 * (length - segment_end)
+            masks.append(np.uint64(((1 << bits) - 1) << shift))
+        return masks
+
+    def __length_pairs(self, keys, length, part, parts):
+        ''' Generates (index1, index2) arrays of pairs of keys of the same length
+        '''
+        segment_masks = self.__segment_masks(length)
+        shared_count = self.__segments_count - self.__max_distance
+        for segments in itertools.combinations(range(self.__segments_count), shared_count):
+            bucket_mask = np.uint64(0)
+            for segment in segments:
+                bucket_mask |= segment_masks[segment]
+
+            buckets = keys & bucket_mask
+            key_indices = np.arange(len(keys))
+            if parts > 1:
+                key_indices = np.flatnonzero(_hash_parts(buckets, parts) == part)
+
+            order = np.argsort(buckets[key_indices], kind='stable')
+            key_indices = key_indices[order]
+            index1, index2 = self.__bucket_pairs(keys, length, segments, key_indices,
+                                                 buckets[key_indices])
+
+            # keep pairs within the distance
+            mismatches = HammingIndex.__mismatches(keys[index1], keys[index2])
+            close = _bit_counts(mismatches) <= self.__max_distance
+            index1 = index1[close]
+            index2 = index2[close]
+            diff = keys[index1] ^ keys[index2]
+
+            # keep pairs, for which these segments are the first shared segments
+            first_shared = np.ones(len(index1), dtype=bool)
+            shared_counts = np.zeros(len(index1), dtype=np.int64)
+            for segment, segment_mask in enumerate(segment_masks):
+                shared = (diff & segment_mask) == 0
+                if segment in segments:
+                    first_shared &= shared & (shared_counts < shared_count)
+                else:
+                    first_shared &= ~shared | (shared_counts >= shared_count)
+                shared_counts += shared
+
+            yield index1[first_shared], index2[first_shared]
+
+    def __bucket_pairs(self, keys, length, segments, key_indices, sorted_buckets):
+        ''' Returns (index1, index2) arrays of indices of keys of all pairs in the same
+            buckets, the buckets are defined by the segments for the keys of key_indices
+        '''
+        starts = np.flatnonzero(np.concatenate(
+            [[True], sorted_buckets[1:] != sorted_buckets[:-1]]))
+        sizes = np.diff(np.concatenate([starts, [len(sorted_buckets)]]))
+        is_large = sizes > HammingIndex.MAX_BUCKET_SIZE
+        if not is_large.any() or self.__segments_count >= length:
+            index1, index2 = _bucket_pairs(sorted_buckets)
+            return key_indices[index1], key_indices[index2]
+
+        is_small = np.repeat(~is_large, sizes)
+        small_indices = key_indices[is_small]
+        index1, index2 = _bucket_pairs(sorted_buckets[is_small])
+        indices1 = [small_indices[index1]]
+        indices2 = [small_indices[index2]]
+
+        # the keys of a large bucket differ only in the other segments, so the pairs within
+        # the distance are found by an index of the keys packed from the other segments
+        bounds = self.__segment_bounds(length)
+        other_segments = [segment for segment in range(self.__segments_count)
+                          if segment not in segments]
+        other_length = sum(bounds[segment + 1] - bounds[segment] for segment in other_segments)
+        for start, size in zip(starts[is_large].tolist(), sizes[is_large].tolist()):
+            bucket_indices = key_indices[start:start + size]
+            bucket_keys = keys[bucket_indices]
+            other_keys = np.ones(size, dtype=np.uint64)
+            for segment in other_segments:
+                bits = np.uint64(2 * (bounds[segment + 1] - bounds[segment]))
+                shift = np.uint64(2 * (length - bounds[segment + 1]))
+                other_keys = (other_keys << bits) | \
+                    ((bucket_keys >> shift) & ((np.uint64(1) << bits) - np.uint64(1)))
+
+            order = np.argsort(other_keys)
+            bucket_indices = bucket_indices[order]
+            index = HammingIndex(other_keys[order], self.__max_distance, self.__segments_count)
+            for index1, index2 in index.__length_pairs(index.__keys, other_length, 0, 1):
+                indices1.append(bucket_indices[index1])
+                indices2.append(bucket_indices[index2])
+        return np.concatenate(indices1), np.concatenate(indices2)
+
+
+class DeletionIndex:
+    ''' Index of packed barcodes to find barcodes that differ by one substitution or one
+        indel
+
+    Each barcode is stored with all its single-deletion variants. Two barcodes of the same
+    length share a deletion variant if they differ by one substitution (the same deleted
+    position) or by an indel that shifts the rest of the barcode window (a deletion in
+    one barcode, and an insertion in the other one). A barcode is also stored as is to be
+    found by the deletion variants of barcodes one nucleotide longer. The barcodes sharing
+    a variant are found by sorting the variants rather than by pairwise comparison.
+
+    The variants are split into parts (by a hash of the variant), each variant is made and
+    hashed once and put into the buffer of its part. The parts are sorted one by one, so
+    a sort is bounded by max_entries variants. The parts can also be processed in several
+    processes.
+    '''
+
+    MAX_ENTRIES = 1 << 24
+
+    def __init__(self, sorted_keys, max_entries=None):
+        '''
+        Args:
+            sorted_keys: uint64 array of distinct packed sequences sorted in ascending order
+            max_entries: the maximum number of variants in a part (MAX_ENTRIES by default)
+        '''
+        if max_entries is None:
+            max_entries = DeletionIndex.MAX_ENTRIES
+
+        self.__keys = sorted_keys
+        self.__length_ranges = length_ranges(sorted_keys)
+        entries_count = sum((end - start) * (length + 1)
+                            for start, end, length in self.__length_ranges)
+        self.__parts_count = max(1, -(-entries_count // max_entries))
+
+    @property
+    def parts_count(self):
+        return self.__parts_count
+
+    def pairs(self, part=0, parts=1):
+        ''' Finds pairs of similar barcodes in a part of the variants
+
+        Args:
+            part: the index of the part of variants
+            parts: the number of parts, each of them takes every parts-th of the parts
+                of the index (see parts_count)
+
+        Returns:
+            (indices, similar_indices): int64 arrays with indices of sorted keys, both
+            (i, j) and (j, i) are reported, the pairs are not ordered and some of them can
+            be reported several times
+        '''
+        index_parts = range(part, self.__parts_count, parts)
+        part_variants = self.__part_variants(index_parts)
+        indices = [np.zeros(0, dtype=np.int64)]
+        similar_indices = [np.zeros(0, dtype=np.int64)]
+        for index_part in index_parts:
+            # the buffers of a part are released as soon as the part is processed
+            variants, key_indices = part_variants.pop(index_part)
+            index1, index2 = DeletionIndex.__variant_pairs(variants, key_indices)
+            indices.extend([index1, index2])
+            similar_indices.extend([index2, index1])
+        return np.concatenate(indices), np.concatenate(similar_indices)
+
+    def __part_variants(self, index_parts):
+        ''' Returns {index part => (variants, key_indices)} with lists of arrays of the
+            variants of the parts and the indices of their keys
+        '''
+        part_variants = {index_part: ([], []) for index_part in index_parts}
+        if not part_variants:
+            return part_variants
+
+        for start, end, length in self.__length_ranges:
+            keys = self.__keys[start:end]
+            # the barcode itself (-1) and the variants without a nucleotide at each position
+            for pos in range(-1, length):
+                if pos < 0:
+                    variants = keys
+                else:
+                    shift = np.uint64(2 * (length - 1 - pos))
+                    low_bits = keys & ((np.uint64(1) << shift) - np.uint64(1))
+                    variants = ((keys >> (shift + np.uint64(2))) << shift) | low_bits
+
+                key_indices = np.arange(start, end)
+                if self.__parts_count == 1:
+                    part_variants[0][0].append(variants)
+                    part_variants[0][1].append(key_indices)
+                    continue
+
+                # the stable sort by part keeps the order of variants within a part
+                variant_parts = _hash_parts(variants, self.__parts_count)
+                order = np.argsort(variant_parts, kind='stable')
+                bounds = np.zeros(self.__parts_count + 1, dtype=np.int64)
+                np.cumsum(np.bincount(variant_parts, minlength=self.__parts_count),
+                          out=bounds[1:])
+                for index_part, (part_variants_list, part_indices_list) \
+                        in part_variants.items():
+                    part_order = order[bounds[index_part]:bounds[index_part + 1]]
+                    part_variants_list.append(variants[part_order])
+                    part_indices_list.append(key_indices[part_order])
+        return part_variants
+
+    @staticmethod
+    def __variant_pairs(variants, key_indices):
+        variants = np.concatenate([np.zeros(0, dtype=np.uint64)] + variants)
+        key_indices = np.concatenate([np.zeros(0, dtype=np.int64)] + key_indices)
+        order = np.argsort(variants, kind='stable')
+        index1, index2 = _bucket_pairs(variants[order])
+        index1 = key_indices[order[index1]]
+        index2 = key_indices[order[index2]]
+
+        # the same barcode can have the same variant for several positions (e.g. AA)
+        different = index1 != index2
+        return index1[different], index2[different]
+
+
+def length_ranges(sorted_keys):
+    ''' Returns (start, end, length) of ranges of sorted keys of the same length
+    '''
+    ranges = []
+    for length in range(MAX_PACKED_LENGTH + 1):
+        start, end = np.searchsorted(
+            sorted_keys, [np.uint64(1 << 2 * length), np.uint64(1 << 2 * length + 1)]).tolist()
+        if start < end:
+            ranges.append((start, end, length))
+    return ranges
+
+
+def _bit_counts(values):
+    ''' Returns the numbers of set bits of uint64 values
+    '''
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    bytes_counts = __BYTE_BIT_COUNTS[np.ascontiguousarray(values).view(np.uint8)]
+    return bytes_counts.reshape(len(values), 8).sum(axis=1, dtype=np.uint8)
+
+
+def _hash_parts(values, parts):
+    ''' Splits uint64 values into parts by a multiplicative hash
+    '''
+    return (((values * __HASH_MULTIPLIER) >> np.uint64(32)) % np.uint64(parts)).astype(np.int64)
+
+
+def _bucket_pairs(buckets):
+    ''' Returns (index1, index2) of all pairs of equal sorted buckets
+    '''
+    starts = np.flatnonzero(np.concatenate([[True], buckets[1:] != buckets[:-1]]))
+    sizes = np.diff(np.concatenate([starts, [len(buckets)]]))
+    starts = starts[sizes > 1]
+    sizes = sizes[sizes > 1]
+
+    index1 = [np.zeros(0, dtype=np.int64)]
+    index2 = [np.zeros(0, dtype=np.int64)]
+    offset = 1
+    while len(starts):
+        # pairs (i, i + offset) within each bucket
+        counts = sizes - offset
+        run_starts = np.cumsum(counts) - counts
+        positions = np.repeat(starts, counts) + \
+            (np.arange(counts.sum()) - np.repeat(run_starts, counts))
+        index1.append(positions)
+        index2.append(positions + offset)
+
+        offset += 1
+        starts = starts[sizes > offset]
+        sizes = sizes[sizes > offset]
+    return np.concatenate(index1), np.concatenate(index2)
@@ -1,6 +1,10 @@
 import os
 import sys
+import stat
+import time
 import argparse
+import multiprocessing
+from . import compression
 
 __ACTG = ['A', 'C', 'G', 'T']
 __RC_ACTG = ['T', 'G', 'C', 'A']
@@ -45,26 +49,250 @@ def process_similar_sequences(chars, processor, *args, **kwargs):
         chars[i] = ch
 
 
-def process_fastq_files(source, processor, *args, **kwargs):
-    process_files(source, processor, ('.fastq', '.fastq.gz'), *args, **kwargs)
+# Nucleotide sequences are packed into ints to be used as compact keys of dictionaries.
+# A sequence of A, C, G, T is packed as a base 4 number with 2 bits per nucleotide
+# (A=0, C=1, G=2, T=3) prefixed by 1 to keep the leading As, e.g. a 20-mer takes 41 bits.
+# A sequence with Ns is packed as a negative base 5 number (N=4), and a sequence with other
+# symbols is not packed at all.
+__PACK_ACGT = str.maketrans('ACGT', '0123')
+__PACK_ACGTN = str.maketrans('ACGTN', '01234')
+__UNPACK_HEX = dict(('%x' % (i * 4 + j), __ACTG[i] + __ACTG[j])
+                    for i in range(4) for j in range(4))
+__UNPACK_HEX_HEAD = dict(('%x' % (4 + i), __ACTG[i]) for i in range(4))
+__UNPACK_HEX_HEAD['1'] = ''
 
 
-def process_files(source, processor, extensions, *args, **kwargs):
-    ''' Iterates over all files defined by source and invokes callback
+def pack_sequence(sequence):
+    ''' Packs a nucleotide sequence into an int (or returns the sequence itself
+        if it has symbols other than A, C, G, T, N)
     '''
+    # the alphabet is checked explicitly, since int() also accepts underscores and whitespace
+    if not sequence.strip('ACGT'):
+        return int('1' + sequence.translate(__PACK_ACGT), 4)
+    if not sequence.strip('ACGTN'):
+        return -int('1' + sequence.translate(__PACK_ACGTN), 5)
+    return sequence
 
-    if os.path.isfile(source):
-        # the srouce is a file
-        file_name = source
-        processor(file_name, *args, **kwargs)
 
-    elif os.path.isdir(source):
-        # the source is a directory
+def unpack_sequence(code):
+    ''' Restores a nucleotide sequence packed by pack_sequence
+    '''
+    if isinstance(code, str):
+        return code
+
+    if code >= 0:
+        # each hex digit stands for two nucleotides, except the first one,
+        # which stands for the leading 1 and possibly one nucleotide
+        digits = '%x' % code
+        return __UNPACK_HEX_HEAD[digits[0]] + ''.join(map(__UNPACK_HEX.__getitem__, digits[1:]))
+
+    code = -code
+    chars = []
+    while code > 1:
+        code, index = divmod(code, 5)
+        chars.append('ACGTN'[index])
+    return ''.join(reversed(chars))
+
+
+def similar_codes(code):
+    ''' Generates packed sequences that differ from a packed sequence by one nucleotide,
+        in the same order as process_similar_sequences does
+    '''
+    if isinstance(code, int) and code > 0:
+        shift = code.bit_length() - 3
+        while shift >= 0:
+            nucleotide = (code >> shift) & 3
+            for _nucleotide in range(4):
+                if _nucleotide != nucleotide:
+                    yield code + ((_nucleotide - nucleotide) << shift)
+            shift -= 2
+    else:
+        chars = list(unpack_sequence(code))
+        for i, ch in enumerate(chars):
+            for _ch in __ACTG:
+                if ch != _ch:
+                    chars[i] = _ch
+                    yield pack_sequence(''.join(chars))
+            chars[i] = ch
+
+
+FASTQ_EXTENSIONS = ('.fastq',)
+
+
+def fastq_extensions():
+    ''' Returns extensions of plain and compressed fastq files
+    '''
+    return tuple(extension + compressed_extension
+                 for extension in FASTQ_EXTENSIONS
+                 for compressed_extension in [''] + compression.compressed_extensions())
+
+
+def process_fastq_files(source, processor, *args, workers=1, callback=None, **kwargs):
+    process_files(source, processor, fastq_extensions(), *args,
+                  workers=workers, callback=callback, **kwargs)
+
+
+def watch_fastq_files(source, processor, manifest_fname, *args, workers=1, callback=None,
+                      interval=None, timeout=None, **kwargs):
+    watch_files(source, processor, fastq_extensions(), manifest_fname, *args,
+                workers=workers, callback=callback, interval=interval, timeout=timeout,
+                **kwargs)
+
+
+STDIN = '-'
+
+
+def is_stream(source):
+    ''' Checks if the source is a stream that can be read only once: stdin or a named pipe
+    '''
+    if source == STDIN:
+        return True
+    try:
+        return stat.S_ISFIFO(os.stat(source).st_mode)
+    except OSError:
+        return False
+
+
+def list_files(source, extensions):
+    ''' Returns the list of files defined by source: a file, a directory,
+        stdin (-) or a named pipe
+    '''
+
+    if is_stream(source) or os.path.isfile(source):
+        return [source]
+
+    file_names = []
+    if os.path.isdir(source):
         for root, _, files in os.walk(source):
             for file in files:
                 if file.endswith(extensions):
-                    file_name = os.path.join(root, file)
-                    processor(file_name, *args, **kwargs)
+                    file_names.append(os.path.join(root, file))
+    return file_names
+
+
+def process_files(source, processor, extensions, *args, workers=1, callback=None, **kwargs):
+    ''' Iterates over all files defined by source and invokes processor.
+        The source can be a file, a directory, stdin (-) or a named pipe
+
+        If workers > 1, the files are processed by a pool of worker processes, the largest
+        files first. The value returned by the processor is passed to the callback
+        (callback(file_name, result)) in the parent process. The callback is invoked in the
+        order of files in the source, regardless of the order the workers finish them
+    '''
+
+    file_names = list_files(source, extensions)
+    for file_name, result in _process_file_list(file_names, processor, workers, args, kwargs):
+        if callback:
+            callback(file_name, result)
+
+
+WATCH_INTERVAL = 60
+WATCH_TIMEOUT = 3600
+
+
+def watch_files(source, processor, extensions, manifest_fname, *args, workers=1,
+                callback=None, interval=None, timeout=None, **kwargs):
+    ''' Watches a directory which is being filled with files (e.g. by a sequencer) and
+        invokes processor for each file as soon as it is complete.
+
+        The directory is polled every interval seconds. A file is considered complete if
+        its size and modification time did not change since the previous poll. The processed
+        files are recorded in the manifest file, so the files already processed (and not
+        changed since then) are skipped after a restart. The results of the processor are
+        passed to the callback as in process_files.
+
+        Watching stops when no file was added or changed for timeout seconds
+        (0 - watch until interrupted)
+    '''
+    interval = WATCH_INTERVAL if interval is None else interval
+    timeout = WATCH_TIMEOUT if timeout is None else timeout
+
+    processed = _read_manifest(manifest_fname)
+    signatures = {}
+    last_change_time = time.time()
+    while True:
+        complete_file_names = []
+        for file_name in list_files(source, extensions):
+            try:
+                file_stat = os.stat(file_name)
+            except OSError:
+                # the file was removed or renamed
+                continue
+            signature = (file_stat.st_size, file_stat.st_mtime_ns)
+            if processed.get(file_name) == signature:
+                continue
+
+            if signatures.get(file_name) == signature:
+                complete_file_names.append(file_name)
+            else:
+                signatures[file_name] = signature
+                last_change_time = time.time()
+
+        if complete_file_names:
+            results = _process_file_list(complete_file_names, processor, workers, args, kwargs)
+            with open(manifest_fname, 'a') as manifest_fp:
+                for file_name, result in results:
+                    if callback:
+                        callback(file_name, result)
+                    processed[file_name] = signatures[file_name]
+                    manifest_fp.write('%s\t%s\t%s\n' % ((file_name,) + signatures[file_name]))
+                    manifest_fp.flush()
+            last_change_time = time.time()
+
+        elif timeout and time.time() - last_change_time >= timeout:
+            break
+
+        time.sleep(interval)
+
+
+def _read_manifest(manifest_fname):
+    # {file name => (size, modification time)}
+    processed = {}
+    if os.path.exists(manifest_fname):
+        with open(manifest_fname) as f:
+            for line in f:
+                file_name, size, mtime = line.rstrip('\n').split('\t')
+                processed[file_name] = (int(size), int(mtime))
+    return processed
+
+
+def _process_file_list(file_names, processor, workers, args, kwargs):
+    if workers > 1 and len(file_names) > 1:
+        return _process_files_parallel(file_names, processor, workers, args, kwargs)
+
+    return ((file_name, processor(file_name, *args, **kwargs))
+            for file_name in file_names)
+
+
+def _process_files_parallel(file_names, processor, workers, args, kwargs):
+    # start with the largest files, so that a run does not end waiting for one big file
+    tasks = sorted(enumerate(file_names), key=lambda task: -os.path.getsize(task[1]))
+
+    # the workers are forked to inherit the state (e.g. Context) of the parent process
+    context = multiprocessing.get_context('fork')
+    with context.Pool(min(workers, len(tasks)), _init_worker, (processor, args, kwargs)) as pool:
+        results = {}
+        next_index = 0
+        for index, result in pool.imap_unordered(_process_file_task, tasks):
+            results[index] = result
+            # release the results in the order of files
+            while next_index in results:
+                yield file_names[next_index], results.pop(next_index)
+                next_index += 1
+
+
+_worker_task = None
+
+
+def _init_worker(processor, args, kwargs):
+    global _worker_task
+    _worker_task = (processor, args, kwargs)
+
+
+def _process_file_task(task):
+    index, file_name = task
+    processor, args, kwargs = _worker_task
+    return index, processor(file_name, *args, **kwargs)
 
 
 class RawDescriptionArgumentDefaultsHelpFormatter(argparse.ArgumentDefaultsHelpFormatter,